@@ -11,21 +11,66 @@ and the EventManager is taken from Zine.
 :license: BSD, see LICENSE for more details.
 """
 
+import atexit
+import copy
+import gc
+import gzip
+import hashlib
 import importlib
+import logging
+import mimetypes
 import os
+import pickle
+import random
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import weakref
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from contextlib import nullcontext
+from contextvars import ContextVar
 
+import click
 from flask import json
 from flask.app import Flask
+from flask.cli import AppGroup
+from flask.ctx import has_app_context
+from flask.ctx import has_request_context
 from flask.globals import current_app
+from flask.globals import g
+from flask.globals import request
+from flask.helpers import send_from_directory
+from flask.helpers import url_for
+from jinja2 import nodes
+from jinja2.exceptions import TemplateSyntaxError
+from jinja2.ext import Extension
+from markupsafe import escape
 from markupsafe import Markup
 from werkzeug.utils import cached_property
 from werkzeug.utils import import_string
 
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
 __version__ = "2.0.0"
 __author__ = "Peter Justin"
 
+log = logging.getLogger(__name__)
+
+# Process-wide discovery results shared by all plugin managers. Keyed by the
+# plugin folder, the plugins package and the state of the plugin folder.
+_discovery_cache: dict[tuple, tuple[dict[str, str], dict[str, str]]] = {}
+
+# The parsed info.json files by their path together with their mtime
+_info_cache: dict[str, tuple[int, dict]] = {}
+
 
 class PluginError(Exception):
     pass
@@ -71,6 +116,36 @@ def get_all_plugins():
     return pm.all_plugins.values()
 
 
+def clear_discovery_cache():
+    """Clears the process-wide cache of the discovered plugins and their
+    metadata which is shared by all :class:`PluginManager` instances.
+    """
+    _discovery_cache.clear()
+    _info_cache.clear()
+
+
+def _load_info(path):
+    info_file = os.path.abspath(os.path.join(path, "info.json"))
+    mtime = os.stat(info_file).st_mtime_ns
+    cached = _info_cache.get(info_file)
+    if cached is None or cached[0] != mtime:
+        with open(info_file) as fd:
+            cached = _info_cache[info_file] = (mtime, json.load(fd))
+    # Every plugin instance gets its own copy of the metadata
+    return copy.deepcopy(cached[1])
+
+
+def query_plugins(**kwargs):
+    """Returns a :class:`PluginPage` with the plugins matching the given
+    filters. See :meth:`PluginManager.query` for the available arguments.
+    """
+    pm = _get_pm()
+    if pm is None:
+        return None
+
+    return pm.query(**kwargs)
+
+
 class Plugin:
     """Every plugin should implement this class. It handles the registration
     for the plugin hooks, creates or modifies additional relations or
@@ -85,8 +160,7 @@ class Plugin:
         #: path.
         self.path: str = os.path.abspath(path)
 
-        with open(os.path.join(path, "info.json")) as fd:
-            self.info = i = json.load(fd)
+        self.info = i = _load_info(path)
 
         #: The plugin's name, as given in info.json. This is the human
         #: readable name.
@@ -171,11 +245,9 @@ class Plugin:
     def disable(self):
         """Disablesthe plugin.
 
-        The app usually has to be restarted after this action because
-        plugins _can_ register blueprints and in order to "unregister" them,
-        the application object has to be destroyed.
-        This is a limitation of Flask and if you want to know more about this
-        visit this link: http://flask.pocoo.org/docs/0.10/blueprints/
+        This only marks the plugin as disabled. The things it registered
+        during its setup stay registered until the app is restarted. Use
+        :meth:`PluginManager.disable_plugins` to unload them right away.
         """
         disabled_file = os.path.join(self.path, "DISABLED")
         try:
@@ -199,10 +271,64 @@ class Plugin:
         """
         pass
 
+    def post_fork(self):  # pragma: no cover
+        """Called in every worker process after it has been forked from a
+        preloaded master process. Per-process resources like database
+        connections, sockets or thread pools should be (re-)created here.
+        See :meth:`PluginManager.preload`.
+        """
+        pass
+
+
+class PluginPage:
+    """A page of plugins as returned by :meth:`PluginManager.query`."""
+
+    def __init__(self, items: list[Plugin], total: int, page: int, per_page: int):
+        #: The plugins on this page.
+        self.items = items
+
+        #: The number of plugins matching the query.
+        self.total = total
+
+        #: The current page number, starting at 1.
+        self.page = page
+
+        #: The maximum number of plugins per page.
+        self.per_page = per_page
+
+    @property
+    def pages(self):
+        """The total number of pages."""
+        if not self.per_page:
+            return 0
+        return -(-self.total // self.per_page)
+
+    @property
+    def has_next(self):
+        """``True`` if a next page exists."""
+        return self.page < self.pages
+
+    @property
+    def has_prev(self):
+        """``True`` if a previous page exists."""
+        return self.page > 1
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
 
 class PluginManager:
     """Collects all Plugins and maps the metadata to the plugin"""
 
+    #: The metadata fields which are indexed for :meth:`query`.
+    indexed_fields = ("author", "license", "version")
+
+    #: The fields :meth:`query` can sort by.
+    sortable_fields = ("identifier", "name", "author", "license", "version")
+
     def __init__(self, app: Flask | None = None, **kwargs):
         """Initializes the PluginManager. It is also possible to initialize the
         PluginManager via a factory. For example::
@@ -216,6 +342,15 @@ class PluginManager:
 
         :param base_app_folder: The base folder for the application. It is used
                                 to build the plugins package name.
+
+        :param profile: Records the wall time and the number of imported
+                        modules of each plugin during startup. Defaults to
+                        the ``PLUGINS_PROFILE_STARTUP`` config value.
+
+        :param trace_memory: Attributes the memory allocated during the
+                             import, construction and setup to each plugin
+                             using :mod:`tracemalloc`. Defaults to the
+                             ``PLUGINS_TRACE_MEMORY`` config value.
         """
         # All enabled plugins
         self._plugins: dict[str, Plugin] | None = None
@@ -229,16 +364,102 @@ class PluginManager:
         # All found plugins
         self._found_plugins: dict[str, str] = dict()
 
+        # Secondary indexes over all plugins which are used by query().
+        # Maps a field to its values and the identifiers having that value.
+        self._indexes: dict[str, dict[object, set[str]]] = dict()
+
+        # The identifiers of all plugins presorted by each sortable field
+        self._sorted: dict[str, list[str]] = dict()
+
+        # Use the process-wide discovery cache
+        self.share_discovery = True
+
+        # The application and the things each plugin registered on it during
+        # its setup, see unload_plugin()
+        self._app: Flask | None = None
+        self._registrations: dict[str, dict[str, set]] = dict()
+
+        # The bit positions of the plugins in the tenant masks. A position
+        # is never reassigned, so the masks stay valid when reloading.
+        self._plugin_bits: dict[str, int] = dict()
+
+        # The enabled plugins per tenant as bitmask over the plugin bits
+        self._tenants: dict[object, int] = dict()
+        self._tenant_loader = None
+
+        # Set by preload()
+        self.preloaded = False
+
+        # Startup timings per plugin package and phase
+        self.profile = False
+        self._startup_profile: dict[str, dict[str, dict[str, float]]] = dict()
+        self._profile_identifiers: dict[str, str] = dict()
+
+        # Net allocated memory per plugin package and phase
+        self.trace_memory = False
+        self._memory_profile: dict[str, dict[str, dict]] = dict()
+
+        #: The number of allocation sites recorded per plugin and phase.
+        self.memory_top_sites = 10
+
         if app is not None:
             self.init_app(app, **kwargs)
 
-    def init_app(self, app, base_app_folder=None, plugin_folder="plugins"):
+    def init_app(
+        self,
+        app,
+        base_app_folder=None,
+        plugin_folder="plugins",
+        profile=None,
+        trace_memory=None,
+    ):
         self._event_manager = EventManager()
         app.jinja_env.globals["emit_event"] = self._event_manager.template_emit
+        app.jinja_env.add_extension(EmitExtension)
+        app.jinja_env.plugin_event_manager = self._event_manager
 
         if not hasattr(app, "extensions"):
             app.extensions = {}
         app.extensions["plugin_manager"] = self
+        app.cli.add_command(plugins_cli)
+        self._app = app
+
+        self._event_manager._owner_bits = self._plugin_bits
+        self._event_manager.mask_loader = self._current_mask
+
+        if profile is None:
+            profile = app.config.get("PLUGINS_PROFILE_STARTUP", False)
+        self.profile = profile
+
+        if trace_memory is None:
+            trace_memory = app.config.get("PLUGINS_TRACE_MEMORY", False)
+        self.trace_memory = trace_memory
+
+        self.share_discovery = app.config.get("PLUGINS_SHARE_DISCOVERY", True)
+
+        self._event_manager.trace_sample_rate = app.config.get(
+            "PLUGINS_TRACE_SAMPLE_RATE", 0.0
+        )
+        for event, budget in app.config.get("PLUGINS_EVENT_BUDGETS", {}).items():
+            self._event_manager.set_budget(event, budget)
+        if app.config.get("PLUGINS_BREAKER_THRESHOLD") is not None:
+            self._event_manager.configure_breakers(
+                threshold=app.config["PLUGINS_BREAKER_THRESHOLD"],
+                slow_call=app.config.get("PLUGINS_BREAKER_SLOW_CALL"),
+                cooldown=app.config.get("PLUGINS_BREAKER_COOLDOWN", 30.0),
+            )
+        if app.config.get("PLUGINS_RECORD_EVENTS"):
+            self._event_manager.start_recording(app.config["PLUGINS_RECORD_EVENTS"])
+        app.before_request(self._event_manager.start_request_trace)
+        app.teardown_request(self._event_manager.finish_request_trace)
+
+        if "PLUGINS_PROCESS_POOL_SIZE" in app.config:
+            self._event_manager.configure_pool(
+                max_workers=app.config["PLUGINS_PROCESS_POOL_SIZE"],
+                timeout=app.config.get("PLUGINS_PROCESS_POOL_TIMEOUT"),
+                max_pending=app.config.get("PLUGINS_PROCESS_POOL_MAX_PENDING"),
+                warm=app.config.get("PLUGINS_PROCESS_POOL_WARM", False),
+            )
 
         if base_app_folder is None:
             base_app_folder = app.root_path.split(os.sep)[-1]
@@ -246,7 +467,32 @@ class PluginManager:
         self.plugin_folder = os.path.join(app.root_path, plugin_folder)
         self.base_plugin_package = ".".join([base_app_folder, plugin_folder])
 
-        self.setup_plugins()
+        start_tracemalloc = self.trace_memory and not tracemalloc.is_tracing()
+        if start_tracemalloc:
+            tracemalloc.start()
+        try:
+            self.setup_plugins()
+        finally:
+            if start_tracemalloc:
+                tracemalloc.stop()
+
+        self.assets_folder = app.config.get(
+            "PLUGINS_ASSETS_FOLDER", os.path.join(app.instance_path, "plugin-assets")
+        )
+        self._asset_manifest = self._load_asset_manifest()
+        # The route and the template global are only registered if the
+        # assets are used
+        if self._asset_manifest or any(
+            key in app.config
+            for key in (
+                "PLUGINS_ASSETS_FOLDER",
+                "PLUGINS_ASSETS_URL_PATH",
+                "PLUGINS_BUILD_ASSETS",
+            )
+        ):
+            self._register_assets()
+        if app.config.get("PLUGINS_BUILD_ASSETS", False):
+            self.build_assets()
 
     @property
     def all_plugins(self):
@@ -271,53 +517,367 @@ class PluginManager:
         self._plugins = {}
         self._all_plugins = {}
         for plugin_name, plugin_package in self.find_plugins().items():
+            plugin_instance = self._load_plugin(plugin_name, plugin_package)
+
+            try:
+                if self._available_plugins[plugin_name]:
+                    self._plugins[plugin_instance.identifier] = plugin_instance
+            except KeyError:
+                pass
+
+            self._all_plugins[plugin_instance.identifier] = plugin_instance
+            self._plugin_bits.setdefault(
+                plugin_instance.identifier, len(self._plugin_bits)
+            )
+
+        self.build_indexes()
+
+    def _load_plugin(self, plugin_name: str, plugin_package: str) -> Plugin:
+        """Imports the plugin class and creates the plugin instance."""
+        package = plugin_package.rsplit(".", 1)[-1]
+        with self._profiled(package, "load"):
             try:
                 plugin_class = import_string(f"{plugin_package}.{plugin_name}")
             except ImportError as e:
                 raise PluginError(
-                    f"Couldn't import {plugin_name} Plugin. Please check if the "
-                    "__plugin__ variable is set correctly."
+                    f"Couldn't import {plugin_name} Plugin. Please check if "
+                    "the __plugin__ variable is set correctly."
                 ) from e
 
-            plugin_path = os.path.join(
-                self.plugin_folder, os.path.basename(plugin_package.replace(".", "/"))
-            )
+            plugin_path = os.path.join(self.plugin_folder, package)
 
             plugin_instance: Plugin = plugin_class(plugin_path)
+        self._profile_identifiers[package] = plugin_instance.identifier
+        return plugin_instance
 
+    def build_indexes(self):
+        """Builds the secondary indexes over all loaded plugins which are
+        used by :meth:`query`. This is done automatically after the plugins
+        have been loaded.
+        """
+        indexes = {field: {} for field in self.indexed_fields}
+        indexes["enabled"] = {True: set(), False: set()}
+        indexes["options"] = {}
+
+        for identifier, plugin in (self._all_plugins or {}).items():
+            for field in self.indexed_fields:
+                value = getattr(plugin, field)
+                indexes[field].setdefault(value, set()).add(identifier)
+            indexes["enabled"][identifier in (self._plugins or {})].add(identifier)
+            for key in plugin.options or ():
+                indexes["options"].setdefault(key, set()).add(identifier)
+
+        self._indexes = indexes
+        self._sorted = {
+            field: sorted(
+                self._all_plugins or (), key=lambda i, f=field: self._order_key(i, f)
+            )
+            for field in self.sortable_fields
+        }
+
+    def _order_key(self, identifier: str, field: str):
+        value = getattr(self._all_plugins[identifier], field)
+        # Sorts ``None`` after all other values
+        return (value is None, value or "", identifier)
+
+    def _update_enabled_index(self, plugin: Plugin, enabled: bool):
+        index = self._indexes.get("enabled")
+        if index is None or plugin.identifier not in (self._all_plugins or {}):
+            return
+        index[not enabled].discard(plugin.identifier)
+        index[enabled].add(plugin.identifier)
+
+    def query(
+        self,
+        enabled: bool | None = None,
+        author: str | None = None,
+        license: str | None = None,
+        version: str | None = None,
+        options: list[str] | None = None,
+        order_by: str = "identifier",
+        reverse: bool = False,
+        page: int = 1,
+        per_page: int | None = None,
+    ) -> PluginPage:
+        """Queries the plugins by their metadata. Filters are looked up in
+        the secondary indexes and combined, so no plugin is looked at unless
+        it matches all of them. For example::
+
+            plugin_manager.query(author="sh4nks", enabled=True, per_page=20)
+
+        :param enabled: Only return enabled (or disabled) plugins.
+        :param author: Only return plugins of this author.
+        :param license: Only return plugins with this license.
+        :param version: Only return plugins with this version.
+        :param options: Only return plugins having all of these keys in
+                        their ``options``.
+        :param order_by: The field to sort by. See :attr:`sortable_fields`.
+        :param reverse: Sort in descending order.
+        :param page: The page to return, starting at 1.
+        :param per_page: The number of plugins per page. Returns all matching
+                         plugins if not given.
+        """
+        if order_by not in self.sortable_fields:
+            raise ValueError(f"Can't sort plugins by {order_by!r}.")
+        if page < 1:
+            raise ValueError("The page number has to be 1 or greater.")
+        if per_page is not None and per_page < 1:
+            raise ValueError("The number of plugins per page has to be 1 or greater.")
+
+        # Makes sure the registry and its indexes are loaded
+        all_plugins = self.all_plugins
+
+        filters = [
+            (field, value)
+            for field, value in (
+                ("enabled", enabled),
+                ("author", author),
+                ("license", license),
+                ("version", version),
+            )
+            if value is not None
+        ]
+        filters.extend(("options", key) for key in options or ())
+
+        order = self._sorted[order_by]
+        if filters:
+            matches = [self._indexes[f].get(v, set()) for f, v in filters]
+            matches.sort(key=len)
+            selected = matches[0].intersection(*matches[1:])
+            if len(selected) * 4 < len(order):
+                # few matches are cheaper to sort on their own
+                identifiers = sorted(
+                    selected, key=lambda i: self._order_key(i, order_by)
+                )
+            else:
+                identifiers = [i for i in order if i in selected]
+            if reverse:
+                identifiers.reverse()
+        else:
+            identifiers = order[::-1] if reverse else order
+
+        total = len(identifiers)
+        if per_page is None:
+            per_page = total
+            start = 0
+        else:
+            start = (page - 1) * per_page
+
+        items = [all_plugins[i] for i in identifiers[start : start + per_page]]
+        return PluginPage(items, total, page, per_page)
+
+    def build_assets(self):
+        """Bundles the CSS and JS files in the ``static`` folders of all
+        enabled plugins into one file per type. The file names contain a
+        fingerprint of their content and gzip (and brotli, if installed)
+        compressed variants are written next to them. This should be done
+        once per deploy, e.g. with ``flask plugins build-assets``.
+
+        The route serving the bundles is registered if needed. This has to
+        happen before the application handles its first request, otherwise
+        a :class:`PluginError` is raised before anything is written.
+
+        Returns a dictionary with the file name of each bundle.
+        """
+        try:
+            self._register_assets()
+        except AssertionError:
+            raise PluginError(
+                "The plugin assets route can't be registered anymore. Configure "
+                "PLUGINS_ASSETS_FOLDER or build the assets before the "
+                "application handles its first request."
+            ) from None
+        os.makedirs(self.assets_folder, exist_ok=True)
+        plugins = sorted(self.plugins.values(), key=lambda p: p.identifier)
+
+        bundles = {}
+        for kind in ("css", "js"):
+            parts = []
+            for plugin in plugins:
+                static_folder = os.path.join(plugin.path, "static")
+                for root, dirs, files in os.walk(static_folder):
+                    dirs.sort()
+                    for name in sorted(files):
+                        if not name.endswith(f".{kind}"):
+                            continue
+                        path = os.path.join(root, name)
+                        relpath = os.path.relpath(path, static_folder)
+                        with open(path, "rb") as fd:
+                            content = fd.read()
+                        header = f"/* {plugin.identifier}/{relpath} */\n"
+                        if kind == "js":
+                            # Guards against files without trailing semicolon
+                            content += b"\n;"
+                        parts.append(header.encode() + content)
+            if not parts:
+                continue
+
+            data = b"\n".join(parts) + b"\n"
+            digest = hashlib.sha256(data).hexdigest()[:16]
+            filename = f"plugins.{digest}.{kind}"
+            variants = {"": data, ".gz": gzip.compress(data, 9, mtime=0)}
+            if brotli is not None:
+                variants[".br"] = brotli.compress(data)
+            for suffix, content in variants.items():
+                _write_atomic(
+                    os.path.join(self.assets_folder, filename + suffix), content
+                )
+            bundles[kind] = filename
+
+        _write_atomic(
+            os.path.join(self.assets_folder, "manifest.json"),
+            json.dumps(bundles).encode(),
+        )
+        self._asset_manifest = bundles
+        return bundles
+
+    def _register_assets(self):
+        app = self._app
+        if app is None or "plugin_assets" in app.view_functions:
+            return
+        url_path = app.config.get("PLUGINS_ASSETS_URL_PATH", "/_plugins/assets")
+        app.add_url_rule(
+            f"{url_path}/<path:filename>",
+            endpoint="plugin_assets",
+            view_func=send_plugin_asset,
+        )
+        app.jinja_env.globals["plugin_assets"] = plugin_assets
+
+    def _load_asset_manifest(self):
+        try:
+            with open(os.path.join(self.assets_folder, "manifest.json")) as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            return {}
+
+    def asset_urls(self):
+        """Returns the URLs of the bundled plugin assets by their type."""
+        return {
+            kind: url_for("plugin_assets", filename=filename)
+            for kind, filename in self._asset_manifest.items()
+        }
+
+    def tenant_loader(self, callback):
+        """Registers a callback which returns the current tenant. Events
+        are then only dispatched to the listeners of the plugins enabled for
+        this tenant, see :meth:`set_tenant_plugins`. For example::
+
+            @plugin_manager.tenant_loader
+            def load_tenant():
+                return g.get("site_id")
+
+        If the callback returns ``None`` or a tenant without own set of
+        plugins, all enabled plugins are used.
+        """
+        self._tenant_loader = callback
+        return callback
+
+    def set_tenant_plugins(self, tenant, identifiers):
+        """Sets the plugins enabled for a tenant. The plugins have to be
+        enabled globally as only their ``setup()`` has been run. Passing
+        ``None`` as `identifiers` removes the tenant's own set of plugins.
+
+        :param tenant: The tenant as returned by the :meth:`tenant_loader`.
+        :param identifiers: The identifiers of the plugins.
+        """
+        if identifiers is None:
+            self._tenants.pop(tenant, None)
+            return
+
+        # Makes sure the plugin bits are assigned
+        if self._all_plugins is None:
+            self.load_plugins()
+
+        mask = 0
+        for identifier in identifiers:
             try:
-                if self._available_plugins[plugin_name]:
-                    self._plugins[plugin_instance.identifier] = plugin_instance
+                mask |= 1 << self._plugin_bits[identifier]
             except KeyError:
-                pass
+                raise PluginError(f"Unknown plugin {identifier!r}.") from None
+        self._tenants[tenant] = mask
 
-            self._all_plugins[plugin_instance.identifier] = plugin_instance
+    def get_tenant_plugins(self, tenant):
+        """Returns the identifiers of the plugins enabled for a tenant or
+        ``None`` if the tenant has no own set of plugins.
+        """
+        mask = self._tenants.get(tenant)
+        if mask is None:
+            return None
+        return [i for i, bit in self._plugin_bits.items() if mask >> bit & 1]
+
+    def _current_mask(self):
+        if self._tenant_loader is None:
+            return None
+        tenant = self._tenant_loader()
+        if tenant is None:
+            return None
+        return self._tenants.get(tenant)
 
     def find_plugins(self):
-        """Find all possible plugins in the plugin folder."""
-        for item in os.listdir(self.plugin_folder):
-            if os.path.isdir(os.path.join(self.plugin_folder, item)) and os.path.exists(
-                os.path.join(self.plugin_folder, item, "__init__.py")
-            ):
-                plugin = ".".join([self.base_plugin_package, item])
+        """Find all possible plugins in the plugin folder. The results are
+        shared with all other plugin managers of the process which use the
+        same plugin folder, until plugins are added, removed, disabled or
+        enabled.
+        """
+        state = self._folder_state()
+        key = (self.plugin_folder, self.base_plugin_package, state)
+
+        cached = None
+        # Profiling has to see the imports of the plugins
+        if self.share_discovery and not (self.profile or self.trace_memory):
+            cached = _discovery_cache.get(key)
+        if cached is None:
+            cached = self._discover(state)
+            if self.share_discovery:
+                # Only the current state of a plugin folder is kept
+                for k in [k for k in _discovery_cache if k[:2] == key[:2]]:
+                    del _discovery_cache[k]
+                _discovery_cache[key] = cached
+
+        found, available = cached
+        self._found_plugins.update(found)
+        self._available_plugins.update(available)
+        return self._found_plugins
 
-                # Same like from exammple.plugins.pluginname import __plugin__
+    def _folder_state(self):
+        """Returns the plugin packages in the plugin folder and whether they
+        are disabled.
+        """
+        state = []
+        with os.scandir(self.plugin_folder) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    continue
+                files = os.listdir(entry.path)
+                if "__init__.py" in files:
+                    state.append((entry.name, "DISABLED" in files))
+        return tuple(sorted(state))
+
+    def _discover(self, state):
+        """Imports the plugin packages and returns the found and the
+        available plugins.
+        """
+        found = {}
+        available = {}
+        for item, disabled in state:
+            plugin = ".".join([self.base_plugin_package, item])
+
+            # Same like from exammple.plugins.pluginname import __plugin__
+            with self._profiled(item, "import"):
                 tmp = importlib.import_module(plugin)
 
-                try:
-                    # Add the plugin to the available plugins if the plugin
-                    # isn't disabled
-                    if not os.path.exists(
-                        os.path.join(self.plugin_folder, item, "DISABLED")
-                    ):
-                        self._available_plugins[tmp.__plugin__] = f"{plugin}"
+            try:
+                # Add the plugin to the available plugins if the plugin
+                # isn't disabled
+                if not disabled:
+                    available[tmp.__plugin__] = f"{plugin}"
 
-                    self._found_plugins[tmp.__plugin__] = f"{plugin}"
+                found[tmp.__plugin__] = f"{plugin}"
 
-                except AttributeError:
-                    pass
+            except AttributeError:
+                pass
 
-        return self._found_plugins
+        return found, available
 
     def setup_plugins(self):  # pragma: no cover
         """Runs the setup for all enabled plugins. Should be run after the
@@ -328,8 +888,259 @@ class PluginManager:
             return
 
         for plugin in self.plugins.values():
-            plugin.enabled = True
+            self._setup_plugin(plugin)
+
+    def _setup_plugin(self, plugin: Plugin):
+        """Runs the setup of a plugin and records what it registered on the
+        application.
+        """
+        app = self._app
+        plugin.enabled = True
+        before = self._app_registrations()
+        with (
+            app.app_context() if app and not has_app_context() else nullcontext(),
+            self._profiled(os.path.basename(plugin.path), "setup"),
+            self._event_manager.owner(plugin.identifier),
+        ):
             plugin.setup()
+        after = self._app_registrations()
+        self._registrations[plugin.identifier] = {
+            key: after[key] - before[key] for key in after
+        }
+
+    def load_plugin(self, plugin: Plugin) -> Plugin:
+        """Imports, creates and sets up an enabled plugin which isn't loaded,
+        e.g. because it was unloaded with :meth:`unload_plugin`. Returns the
+        new plugin instance, which replaces the given one in
+        :attr:`all_plugins` and :attr:`plugins`.
+
+        As the setup may register blueprints, this is only possible until
+        the application handles its first request. Afterwards a
+        :class:`PluginError` is raised.
+        """
+        loaded = self.plugins.get(plugin.identifier)
+        if loaded is not None:
+            return loaded
+
+        app = self._app
+        if app is not None and app._got_first_request:
+            raise PluginError(
+                f"The plugin {plugin.identifier!r} can't be loaded after the "
+                "application handled its first request. Restart the "
+                "application instead."
+            )
+
+        package = f"{self.base_plugin_package}.{os.path.basename(plugin.path)}"
+        plugin_name = next(
+            (n for n, p in self.find_plugins().items() if p == package), None
+        )
+        if plugin_name is None:
+            raise PluginError(f"Couldn't find the plugin {plugin.identifier!r}.")
+
+        instance = self._load_plugin(plugin_name, package)
+        self._all_plugins[instance.identifier] = instance
+        self._plugins[instance.identifier] = instance
+        self._setup_plugin(instance)
+        return instance
+
+    def _app_registrations(self):
+        """Returns the Jinja globals, blueprints, URL rules and view
+        functions currently registered on the application.
+        """
+        app = self._app
+        if app is None:
+            return {}
+        return {
+            "globals": set(app.jinja_env.globals),
+            "blueprints": set(app.blueprints),
+            # rules aren't hashable
+            "rules": {id(rule) for rule in app.url_map.iter_rules()},
+            "endpoints": set(app.view_functions),
+        }
+
+    def unload_plugin(self, plugin: Plugin):
+        """Tears down everything the plugin registered during its setup:
+        its event listeners, Jinja globals, blueprints, URL rules and view
+        functions. Afterwards the plugin's modules are removed from
+        ``sys.modules`` and the plugin instance is replaced with a plain
+        :class:`Plugin` holding its metadata, so that the plugin's code and
+        objects can be garbage collected. The plugin can be loaded again
+        with :meth:`load_plugin`.
+
+        Only plugins which have been set up by this manager are unloaded.
+        Returns ``True`` if the plugin was unloaded.
+        """
+        identifier = plugin.identifier
+        if (self._plugins or {}).get(identifier) is not plugin:
+            return False
+
+        self._event_manager.remove_owned(identifier)
+
+        registrations = self._registrations.pop(identifier, {})
+        app = self._app
+        if app is not None and registrations:
+            for name in registrations["globals"]:
+                app.jinja_env.globals.pop(name, None)
+            for name in registrations["endpoints"]:
+                app.view_functions.pop(name, None)
+            for name in registrations["blueprints"]:
+                app.blueprints.pop(name, None)
+                for funcs in (
+                    app.before_request_funcs,
+                    app.after_request_funcs,
+                    app.teardown_request_funcs,
+                    app.url_default_functions,
+                    app.url_value_preprocessors,
+                    app.template_context_processors,
+                    app.error_handler_spec,
+                ):
+                    funcs.pop(name, None)
+            if registrations["rules"]:
+                _remove_url_rules(app, registrations["rules"])
+            if app.jinja_env.cache is not None:
+                app.jinja_env.cache.clear()
+
+        package = f"{self.base_plugin_package}.{os.path.basename(plugin.path)}"
+        for name in [
+            n for n in sys.modules if n == package or n.startswith(f"{package}.")
+        ]:
+            del sys.modules[name]
+        parent, _, child = package.rpartition(".")
+        if parent in sys.modules:
+            sys.modules[parent].__dict__.pop(child, None)
+
+        del self._plugins[identifier]
+        if self._all_plugins is not None:
+            self._all_plugins[identifier] = Plugin(plugin.path)
+        plugin.enabled = False
+        return True
+
+    def preload(self, freeze_gc: bool = True):
+        """Does all the loading eagerly so that it can happen once in the
+        master process of a preforking server like gunicorn with
+        ``--preload``. The workers then share the plugins copy-on-write.
+
+        All plugins and their metadata are loaded, the listener tables are
+        frozen and, if `freeze_gc` is ``True``, all objects are moved to the
+        permanent generation of the garbage collector using
+        :func:`gc.freeze`. This way the garbage collector of the workers
+        doesn't touch (and therefore copy) the shared memory pages.
+
+        This has to be the last thing done before forking. In the workers
+        :meth:`post_fork` has to be called.
+        """
+        for plugin in self.all_plugins.values():
+            # The license text is cached after it has been read once
+            _ = plugin.license_text
+        self._event_manager.freeze()
+
+        if freeze_gc:
+            gc.collect()
+            gc.freeze()
+        self.preloaded = True
+
+    def post_fork(self):
+        """Re-creates the per-process resources in a forked worker. Resets
+        the memoization counters, replaces the process pool inherited from
+        the master process and calls :meth:`Plugin.post_fork` for all
+        enabled plugins. With gunicorn, call it from the ``post_fork``
+        server hook.
+        """
+        self._event_manager.reset_memo_stats()
+        self._event_manager.shutdown_pool()
+        if self._event_manager._pool_warm:
+            self._event_manager.start_pool()
+        for plugin in self.plugins.values():
+            plugin.post_fork()
+
+    @contextmanager
+    def _profiled(self, package: str, phase: str):
+        """Records the wall time and the number of newly imported modules of
+        a startup phase of a plugin if profiling is enabled and the memory
+        allocated during the phase if memory tracing is enabled.
+        """
+        snapshot = None
+        if self.trace_memory and tracemalloc.is_tracing():
+            snapshot = _take_snapshot()
+        elif not self.profile:
+            yield
+            return
+
+        modules = len(sys.modules)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            if self.profile:
+                self._startup_profile.setdefault(package, {})[phase] = {
+                    "time": duration,
+                    "modules": len(sys.modules) - modules,
+                }
+            if snapshot is not None:
+                stats = _take_snapshot().compare_to(snapshot, "lineno")
+                top = [s for s in stats if s.size_diff > 0]
+                self._memory_profile.setdefault(package, {})[phase] = {
+                    "size": sum(s.size_diff for s in stats),
+                    "top": [
+                        (str(s.traceback), s.size_diff)
+                        for s in top[: self.memory_top_sites]
+                    ],
+                }
+
+    def memory_report(self):
+        """Returns the memory allocated by each plugin during its import,
+        construction and setup together with the plugin's metadata, heaviest
+        plugins first. Every phase contains the net allocated bytes and the
+        top allocation sites as ``(location, bytes)`` tuples. Returns
+        ``None`` if memory tracing is disabled.
+        """
+        if not self.trace_memory:
+            return None
+
+        plugins = []
+        for package, entry in self._memory_profile.items():
+            identifier = self._profile_identifiers.get(package, package)
+            plugin = (self._all_plugins or {}).get(identifier)
+            plugins.append(
+                {
+                    "plugin": identifier,
+                    "package": package,
+                    "name": getattr(plugin, "name", None),
+                    "version": getattr(plugin, "version", None),
+                    "phases": dict(entry),
+                    "size": sum(v["size"] for v in entry.values()),
+                }
+            )
+        plugins.sort(key=lambda p: p["size"], reverse=True)
+        return plugins
+
+    def startup_report(self):
+        """Returns the startup profile of all plugins, slowest plugins
+        first. Every plugin entry contains the timings of the ``import``,
+        ``load`` and ``setup`` phases and the number of modules they
+        imported. ``phases`` holds the total time spent in each phase.
+        Returns ``None`` if profiling is disabled.
+        """
+        if not self.profile:
+            return None
+
+        plugins = []
+        phases = {"import": 0.0, "load": 0.0, "setup": 0.0}
+        for package, entry in self._startup_profile.items():
+            for phase, values in entry.items():
+                phases[phase] += values["time"]
+            plugins.append(
+                {
+                    "plugin": self._profile_identifiers.get(package, package),
+                    "package": package,
+                    "phases": dict(entry),
+                    "time": sum(v["time"] for v in entry.values()),
+                    "modules": sum(v["modules"] for v in entry.values()),
+                }
+            )
+        plugins.sort(key=lambda p: p["time"], reverse=True)
+        return {"plugins": plugins, "phases": phases}
 
     def install_plugins(self, plugins: dict[str, Plugin] | None = None):
         """Installs one or more plugins.
@@ -369,47 +1180,214 @@ class PluginManager:
             with current_app.app_context():
                 plugin.uninstall()
 
-    def enable_plugins(self, plugins: list[Plugin] | None = None):
+    def enable_plugins(self, plugins: list[Plugin] | None = None, load=True):
         """Enables one or more plugins.
 
         It either returns the amount of enabled plugins or
         raises an exception caused by ``os.remove`` which says most likely
         that you can't write on the filesystem.
 
+        Plugins which aren't loaded, e.g. because they have been unloaded by
+        :meth:`disable_plugins`, are loaded and set up right away, see
+        :meth:`load_plugin`.
+
         :param plugins: An iterable with plugins.
+        :param load: Set to ``False`` to only enable the plugins, they are
+                     then loaded when the application is restarted.
         """
+        plugins = list(plugins or [])
+        if load and self._plugins is not None:
+            app = self._app
+            if (
+                app is not None
+                and app._got_first_request
+                and any(p.identifier not in self._plugins for p in plugins)
+            ):
+                raise PluginError(
+                    "Plugins can't be loaded after the application handled "
+                    "its first request. Pass load=False and restart the "
+                    "application instead."
+                )
+
         _enabled_count = 0
-        for plugin in plugins or []:
+        for plugin in plugins:
             plugin.enable()
+            self._update_enabled_index(plugin, True)
+            if load and self._plugins is not None:
+                self.load_plugin(plugin)
             _enabled_count += 1
         return _enabled_count
 
-    def disable_plugins(self, plugins: list[Plugin] | None = None):
+    def disable_plugins(self, plugins: list[Plugin] | None = None, unload=True):
         """Disables one or more plugins.
         It either returns the amount of disabled plugins or
         raises an exception caused by ``open`` which says most likely
         that you can't write on the filesystem.
 
-        The app usually has to be restarted after this action because
-        plugins **can** register blueprints and in order to "unregister" them,
-        the application object has to be destroyed.
-        This is a limitation of Flask and if you want to know more about this
-        visit this link: http://flask.pocoo.org/docs/0.10/blueprints/
+        Plugins set up by this manager are unloaded right away, see
+        :meth:`unload_plugin`.
 
         :param plugins: An iterable with plugins
+        :param unload: Set to ``False`` to keep the plugins loaded until the
+                       application is restarted.
         """
         _disabled_count = 0
         for plugin in plugins or []:
             plugin.disable()
+            self._update_enabled_index(plugin, False)
+            if unload:
+                self.unload_plugin(plugin)
             _disabled_count += 1
         return _disabled_count
 
 
-def connect_event(event, callback, position="after"):
+plugins_cli = AppGroup("plugins", help="Inspect the application's plugins.")
+
+
+@plugins_cli.command("replay")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--nested", is_flag=True, help="Replay nested events, too.")
+def replay_command(path, nested):
+    """Replays a recording of emitted events against the local plugins."""
+    app = current_app._get_current_object()
+    with app.test_request_context():
+        report = replay_events(path, include_nested=nested)
+
+    click.echo(
+        f"{'Event':<40} {'count':>7} {'recorded':>10} {'replayed':>10} {'change':>8}"
+    )
+    for event, entry in sorted(
+        report["events"].items(), key=lambda e: e[1]["replayed_mean"], reverse=True
+    ):
+        change = entry["change"]
+        click.echo(
+            f"{event:<40} {entry['count']:>7} "
+            f"{entry['recorded_mean'] * 1000:>8.3f}ms "
+            f"{entry['replayed_mean'] * 1000:>8.3f}ms "
+            + (f"{change:>+8.1%}" if change is not None else f"{'-':>8}")
+        )
+    for name in ("recorded", "replayed"):
+        throughput = report[f"{name}_throughput"]
+        if throughput is not None:
+            click.echo(f"{name.capitalize()} throughput: {throughput:.0f} emits/s")
+
+
+@plugins_cli.command("build-assets")
+def build_assets_command():
+    """Bundles the static CSS and JS files of the enabled plugins."""
+    bundles = _get_pm().build_assets()
+    if not bundles:
+        click.echo("No plugin assets found.")
+    for filename in bundles.values():
+        click.echo(f"Built {filename}")
+
+
+@plugins_cli.command("profile")
+@click.option("--limit", "-n", default=10, help="Number of plugins to show.")
+def profile_command(limit):
+    """Shows the plugins which are the slowest to start."""
+    report = _get_pm().startup_report()
+    if report is None:
+        raise click.ClickException(
+            "Startup profiling is disabled. Set PLUGINS_PROFILE_STARTUP to enable it."
+        )
+
+    click.echo(
+        f"{'Plugin':<30} {'import':>10} {'load':>10} {'setup':>10} "
+        f"{'total':>10} {'modules':>8}"
+    )
+    for entry in report["plugins"][:limit]:
+        timings = [
+            entry["phases"].get(phase, {}).get("time", 0.0) * 1000
+            for phase in ("import", "load", "setup")
+        ]
+        click.echo(
+            f"{entry['plugin']:<30} "
+            + " ".join(f"{t:>8.2f}ms" for t in timings)
+            + f" {entry['time'] * 1000:>8.2f}ms {entry['modules']:>8}"
+        )
+
+
+def plugin_assets():
+    """Returns the tags including the bundled CSS and JS files of the
+    plugins. It is available in the templates::
+
+        {{ plugin_assets() }}
+    """
+    urls = _get_pm().asset_urls()
+    tags = []
+    if "css" in urls:
+        tags.append(f'<link rel="stylesheet" href="{escape(urls["css"])}">')
+    if "js" in urls:
+        tags.append(f'<script src="{escape(urls["js"])}" defer></script>')
+    return Markup("\n".join(tags))
+
+
+def send_plugin_asset(filename):
+    """Sends a bundled plugin asset. A precompressed variant is sent if the
+    client accepts it. As the file names contain a fingerprint of their
+    content, the assets can be cached forever.
+    """
+    folder = _get_pm().assets_folder
+    mimetype = mimetypes.guess_type(filename)[0]
+    encoding = None
+    for name, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if request.accept_encodings[name] and os.path.isfile(
+            os.path.join(folder, filename + suffix)
+        ):
+            encoding = name
+            filename += suffix
+            break
+
+    rv = send_from_directory(folder, filename, mimetype=mimetype, max_age=31536000)
+    if encoding is not None:
+        rv.headers["Content-Encoding"] = encoding
+    rv.vary.add("Accept-Encoding")
+    rv.cache_control.public = True
+    rv.cache_control.immutable = True
+    return rv
+
+
+def connect_event(
+    event,
+    callback,
+    position="after",
+    pure=False,
+    offload=False,
+    low_priority=False,
+    endpoints=None,
+    blueprints=None,
+    static=False,
+    batch=False,
+):
     """Connect a callback to an event.  Per default the callback is
     appended to the end of the handlers but handlers can ask for a higher
     privilege by setting `position` to ``'before'``.
 
+    If `pure` is set to ``True`` the callback is considered request-pure:
+    its result for a given set of arguments is memoized for the rest of the
+    current request.
+
+    If `offload` is set to ``True`` the callback is executed in the process
+    pool of the :class:`EventManager`. This is meant for CPU-bound callbacks.
+    The callback and its arguments have to be picklable and it runs without
+    an application or request context.
+
+    If `low_priority` is set to ``True`` the callback is skipped once the
+    latency budget of the event is spent.
+
+    If `endpoints` or `blueprints` are given, the callback is only called
+    while handling a request to one of these endpoints or blueprints.
+
+    If `static` is set to ``True`` the callback always returns the same
+    markup and is called without arguments, also when the event is emitted
+    with arguments. Its output is then folded into the templates using the
+    ``{% emit %}`` tag when they are compiled, see :class:`EmitExtension`.
+
+    If `batch` is set to ``True`` the callback supports batches: when the
+    event is emitted with :func:`emit_batch`, it is called once with the
+    list of all items and has to return a list with one result per item.
+
     Example usage::
 
         def on_before_metadata_assembled(metadata):
@@ -423,7 +1401,18 @@ def connect_event(event, callback, position="after"):
     if em is None:
         return iter(())
 
-    em.connect(event, callback, position)
+    em.connect(
+        event,
+        callback,
+        position,
+        pure=pure,
+        offload=offload,
+        low_priority=low_priority,
+        endpoints=endpoints,
+        blueprints=blueprints,
+        static=static,
+        batch=batch,
+    )
 
 
 def emit_event(event, *args, **kwargs):
@@ -440,7 +1429,25 @@ def emit_event(event, *args, **kwargs):
     if em is None:
         return iter(())
 
-    return [x(*args, **kwargs) for x in em.iter(event)]
+    return em.emit(event, *args, **kwargs)
+
+
+def emit_batch(event, items, *args, **kwargs):
+    """Emit an event once for every item and return a list with the list of
+    event results for each item. Listeners connected with ``batch=True``
+    are called only once with all items, the other listeners are called for
+    each item. The item is passed as first argument, followed by the other
+    arguments.
+
+    This is equivalent to, but usually a lot cheaper than::
+
+        [emit_event(event, item, *args, **kwargs) for item in items]
+    """
+    em = _get_em()
+    if em is None:
+        return iter(())
+
+    return em.emit_batch(event, items, *args, **kwargs)
 
 
 def iter_listeners(event):
@@ -459,46 +1466,1380 @@ class EventManager:
     """
 
     def __init__(self):
+        # The connected listeners per event, see _Listener
         self._listeners = {}
         self._last_listener = 0
 
-    def connect(self, event, callback, position="after"):
-        """Connect a callback to an event."""
+        # Events whose listeners are all request-pure
+        self._pure_events = set()
+
+        # The callbacks of events which need none of the features below and
+        # are emitted by calling the callbacks one after another
+        self._plain: dict[str, tuple] = {}
+
+        # Memoization counters per event
+        self._memo_hits: dict[str, int] = {}
+        self._memo_misses: dict[str, int] = {}
+
+        #: The fraction of requests whose emitted events are traced.
+        self.trace_sample_rate = 0.0
+
+        #: The most recent finished traces.
+        self.traces: deque[EventTrace] = deque(maxlen=100)
+
+        # The recorder of the emitted events, see start_recording()
+        self._recorder: _EventRecorder | None = None
+
+        # The plugin whose setup is currently running
+        self._current_owner: str | None = None
+
+        # Bit positions of the plugins in the tenant masks, the callable
+        # returning the mask of the current tenant (or ``None`` to dispatch
+        # to all listeners) and the dispatch lists per (event, mask)
+        self._owner_bits: dict[str, int] = {}
+        self.mask_loader = None
+        self._dispatch_cache: dict[tuple, tuple] = {}
+
+        # The events having listeners scoped to endpoints or blueprints
+        self._scoped_events: set[str] = set()
+
+        # The version of each event's listeners and callbacks notified when
+        # they change
+        self._versions: dict[str, int] = {}
+        self._watchers: list = []
+
+        # Latency budgets in seconds per event
+        self._budgets: dict[str, float] = {}
+
+        #: Failures (exceptions or slow calls) in a row after which the
+        #: circuit breaker of a listener trips. Exceptions of listeners are
+        #: only isolated if this is set.
+        self.breaker_threshold: int | None = None
+
+        #: Calls of a listener taking longer than this many seconds count as
+        #: failure.
+        self.breaker_slow_call: float | None = None
+
+        #: Seconds a tripped listener is bypassed before it is tried again.
+        self.breaker_cooldown = 30.0
+
+        # The process pool is created lazily and per process. The lock guards
+        # the pool and the pending counter and is never replaced.
+        self._pool: ProcessPoolExecutor | None = None
+        self._pool_pid: int | None = None
+        self._pool_lock = threading.Lock()
+        self._pool_pending = 0
+        self._pool_options: dict[str, object] = {}
+        self._pool_warm = False
+
+        #: Seconds to wait for the result of an offloaded listener.
+        self.pool_timeout: float | None = None
+
+        #: Offloaded calls which may be queued in the pool before listeners
+        #: are executed inline instead.
+        self.pool_max_pending = (os.cpu_count() or 1) * 2
+
+    def connect(
+        self,
+        event,
+        callback,
+        position="after",
+        pure=False,
+        offload=False,
+        low_priority=False,
+        endpoints=None,
+        blueprints=None,
+        static=False,
+        batch=False,
+    ):
+        """Connect a callback to an event. If `pure` is ``True`` the results
+        of the callback are memoized for the current request. If `offload` is
+        ``True`` the callback is executed in the process pool. If
+        `low_priority` is ``True`` the callback is skipped once the latency
+        budget of the event is spent. If `endpoints` or `blueprints` are
+        given, the callback is only called in requests to them. If `static`
+        is ``True`` the output of the callback may be folded into templates.
+        If `batch` is ``True`` the callback is called with all items when
+        the event is emitted with :meth:`emit_batch`.
+        """
         assert position in ("before", "after"), "invalid position"
         listener_id = self._last_listener
         event = sys.intern(event)
+        self._thaw(event)
+        scope = None
+        if endpoints is not None or blueprints is not None:
+            scope = (_as_frozenset(endpoints), _as_frozenset(blueprints))
+        listener = _Listener(
+            callback,
+            pure=pure,
+            offload=offload,
+            low_priority=low_priority,
+            scope=scope,
+            static=static,
+            batch=batch,
+            owner=self._current_owner,
+        )
         if event not in self._listeners:
-            self._listeners[event] = deque([callback])
+            self._listeners[event] = deque([listener])
         elif position == "after":
-            self._listeners[event].append(callback)
+            self._listeners[event].append(listener)
         elif position == "before":
-            self._listeners[event].appendleft(callback)
+            self._listeners[event].appendleft(listener)
+        self._changed(event)
         self._last_listener += 1
         return listener_id
 
     def remove(self, event, callback):
-        """Remove a callback again."""
+        """Remove a callback again. If it is connected more than once, the
+        first connection is removed.
+        """
+        listener = self._find(event, callback)
+        if listener is not None:
+            self._thaw(event)
+            self._listeners[event].remove(listener)
+            self._changed(event)
+
+    def remove_owned(self, identifier):
+        """Removes all listeners connected by the plugin with the given
+        identifier. Returns the number of removed listeners.
+        """
+        removed = 0
+        for event, listeners in list(self._listeners.items()):
+            owned = [x for x in listeners if x.owner == identifier]
+            if not owned:
+                continue
+            self._thaw(event)
+            for listener in owned:
+                self._listeners[event].remove(listener)
+            self._changed(event)
+            removed += len(owned)
+        return removed
+
+    def _find(self, event, callback):
+        for listener in self._listeners.get(event, ()):
+            if listener.callback == callback:
+                return listener
+        return None
+
+    def _changed(self, event):
+        self._dispatch_cache.clear()
+        if any(listener.scope for listener in self._listeners.get(event, ())):
+            self._scoped_events.add(event)
+        else:
+            self._scoped_events.discard(event)
+        self._update_plain(event)
+        self._versions[event] = self._versions.get(event, 0) + 1
+        for callback in self._watchers:
+            callback(event)
+
+    def _update_plain(self, event):
+        listeners = self._listeners.get(event, ())
+        if (
+            event in self._pure_events
+            or event in self._budgets
+            or any(
+                listener.pure or listener.offload or listener.static or listener.scope
+                for listener in listeners
+            )
+        ):
+            self._plain.pop(event, None)
+        else:
+            self._plain[event] = tuple(listener.callback for listener in listeners)
+
+    def version(self, event):
+        """Returns a number which changes whenever a listener of the event is
+        connected or removed.
+        """
+        return self._versions.get(event, 0)
+
+    def watch(self, callback):
+        """Registers a callback which is called with the name of the event
+        whenever a listener of an event is connected or removed.
+        """
+        self._watchers.append(callback)
+
+    def is_static(self, event, callback):
+        """Returns ``True`` if the callback was connected as static."""
+        listener = self._find(event, callback)
+        return listener is not None and listener.static
+
+    def can_fold(self, event):
+        """Returns ``True`` if the output of the static listeners of the
+        event may currently be folded into templates. This isn't the case
+        if the listeners are filtered per request or their calls guarded,
+        or while the events are recorded or traced.
+        """
+        return (
+            self._recorder is None
+            and _current_trace.get() is None
+            and event not in self._scoped_events
+            and event not in self._budgets
+            and self.breaker_threshold is None
+            and not any(listener.offload for listener in self._listeners.get(event, ()))
+            and (self.mask_loader is None or self.mask_loader() is None)
+        )
+
+    def set_pure(self, event, pure=True):
+        """Declares all listeners of an event as request-pure. Their results
+        are memoized per request, keyed by the event and its arguments.
+        """
+        event = sys.intern(event)
+        if pure:
+            self._pure_events.add(event)
+        else:
+            self._pure_events.discard(event)
+        self._update_plain(event)
+
+    def is_pure(self, event, callback):
+        """Returns ``True`` if the callback's results for the event may be
+        memoized for the current request.
+        """
+        if event in self._pure_events:
+            return True
+        listener = self._find(event, callback)
+        return listener is not None and listener.pure
+
+    def memo_stats(self):
+        """Returns the memoization hit and miss counters per event. Useful
+        to check whether declaring an event or listener pure pays off.
+        """
+        events = set(self._memo_hits) | set(self._memo_misses)
+        return {
+            event: {
+                "hits": self._memo_hits.get(event, 0),
+                "misses": self._memo_misses.get(event, 0),
+            }
+            for event in events
+        }
+
+    def reset_memo_stats(self):
+        """Resets the memoization counters."""
+        self._memo_hits.clear()
+        self._memo_misses.clear()
+
+    def call(self, event, callback, *args, **kwargs):
+        """Calls a single listener of an event. Request-pure listeners are
+        served from the request-local memo if possible. Static listeners are
+        called without arguments.
+        """
+        listener = self._find(event, callback) or _Listener(callback)
+        return self._call(event, listener, args, kwargs)
+
+    def _call(self, event, listener, args, kwargs):
+        callback = listener.callback
+        if listener.static:
+            args, kwargs = (), {}
+        if (
+            not (listener.pure or event in self._pure_events)
+            or not has_request_context()
+        ):
+            return callback(*args, **kwargs)
+
+        memo = g.setdefault("_flask_plugins_memo", {})
         try:
-            self._listeners[event].remove(callback)
-        except (KeyError, ValueError):
-            pass
+            key = (id(self), event, listener, args, frozenset(kwargs.items()))
+            if key in memo:
+                self._memo_hits[event] = self._memo_hits.get(event, 0) + 1
+                return memo[key]
+        except TypeError:
+            # Unhashable arguments can't be memoized
+            return callback(*args, **kwargs)
+
+        self._memo_misses[event] = self._memo_misses.get(event, 0) + 1
+        rv = memo[key] = callback(*args, **kwargs)
+        return rv
+
+    def emit(self, event, *args, **kwargs):
+        """Calls all listeners of an event and returns a list with their
+        results. Offloaded listeners are submitted to the process pool in
+        the order of the listeners and run in parallel to the inline
+        listeners following them. The results are returned in the order of
+        the listeners.
+        """
+        plain = self._plain_listeners(event)
+        if plain is not None:
+            return [f(*args, **kwargs) for f in plain]
+
+        trace = _current_trace.get()
+        recorder = self._recorder
+        if recorder is None:
+            return self._traced_emit(event, args, kwargs, trace)
+        with recorder.record("e", event, args, kwargs):
+            return self._traced_emit(event, args, kwargs, trace)
+
+    def _plain_listeners(self, event):
+        # Returns the callbacks of the event if none of the features applies
+        # and they can simply be called one after another
+        plain = self._plain.get(event)
+        if (
+            plain is None
+            or self._recorder is not None
+            or self.breaker_threshold is not None
+            or _current_trace.get() is not None
+            or (self.mask_loader is not None and self.mask_loader() is not None)
+        ):
+            return None
+        return plain
+
+    def _traced_emit(self, event, args, kwargs, trace):
+        if trace is None:
+            return self._emit(event, args, kwargs, None)
+        with trace.frame(f"emit {event}"):
+            return self._emit(event, args, kwargs, trace)
+
+    def _emit(self, event, args, kwargs, trace):
+        budget = self._budgets.get(event)
+        guarded = budget is not None or self.breaker_threshold is not None
+        start = time.perf_counter()
+
+        results = []
+        # The positions of the offloaded calls in the results
+        submitted = {}
+        for listener in self._iter(event):
+            if guarded and not self._allowed(listener, budget, start):
+                continue
+
+            future = None
+            if listener.offload:
+                if listener.static:
+                    future = self.submit(listener.callback)
+                else:
+                    future = self.submit(listener.callback, *args, **kwargs)
+            if future is not None:
+                submitted[len(results)] = (listener, time.perf_counter())
+                results.append(future)
+                continue
+
+            call = self._guarded_call if guarded else self._call
+            if trace is None:
+                rv = call(event, listener, args, kwargs)
+            else:
+                with trace.frame(_callable_name(listener.callback)):
+                    rv = call(event, listener, args, kwargs)
+            if rv is not _skipped:
+                results.append(rv)
+        if not submitted:
+            return results
+        results = [
+            self._pool_result(event, rv, *submitted[i], guarded)
+            if i in submitted
+            else rv
+            for i, rv in enumerate(results)
+        ]
+        return [rv for rv in results if rv is not _skipped]
+
+    def _pool_result(self, event, future, listener, start, guarded):
+        if not guarded or self.breaker_threshold is None:
+            return future.result(self.pool_timeout)
+
+        breaker = self._breaker(listener)
+        try:
+            rv = future.result(self.pool_timeout)
+        except Exception:
+            # A timeout counts as slow call
+            log.exception(
+                "Offloaded listener %s of %s failed.",
+                _callable_name(listener.callback),
+                event,
+            )
+            breaker.record(failed=True)
+            return _skipped
+
+        slow = self.breaker_slow_call
+        breaker.record(failed=slow is not None and time.perf_counter() - start > slow)
+        return rv
+
+    def emit_batch(self, event, items, *args, **kwargs):
+        """Emits the event for every item and returns a list with the
+        results of the listeners for each item. Listeners connected with
+        ``batch=True`` are called once with the list of all items and have
+        to return one result per item. The other listeners are called for
+        each item and always executed inline.
+
+        If the circuit breakers are enabled, a failing listener doesn't
+        contribute to the results of the failed items. A batch listener
+        returning the wrong number of results counts as failure. Otherwise
+        a :class:`PluginError` is raised.
+        """
+        items = list(items)
+        if not items:
+            return []
+        recorder = self._recorder
+        if recorder is None:
+            return self._emit_batch(event, items, args, kwargs)
+        with recorder.record("b", event, (items, *args), kwargs):
+            return self._emit_batch(event, items, args, kwargs)
+
+    def _emit_batch(self, event, items, args, kwargs):
+        budget = self._budgets.get(event)
+        guarded = budget is not None or self.breaker_threshold is not None
+        trace = _current_trace.get()
+        start = time.perf_counter()
+
+        rows: list[list] = [[] for _ in items]
+        with trace.frame(f"emit_batch {event}") if trace else nullcontext():
+            for listener in self._iter(event):
+                if guarded and not self._allowed(listener, budget, start):
+                    continue
+
+                if trace is None:
+                    results = self._batch_results(
+                        event, listener, guarded, items, args, kwargs
+                    )
+                else:
+                    with trace.frame(_callable_name(listener.callback)):
+                        results = self._batch_results(
+                            event, listener, guarded, items, args, kwargs
+                        )
+                if results is _skipped:
+                    continue
+
+                for row, rv in zip(rows, results, strict=True):
+                    if rv is not _skipped:
+                        row.append(rv)
+        return rows
+
+    def _batch_results(self, event, listener, guarded, items, args, kwargs):
+        if listener.batch:
+            return self._batch_call(
+                event, listener, guarded, (items, *args), kwargs, self._call_batch
+            )
+        return [
+            self._batch_call(event, listener, guarded, (item, *args), kwargs)
+            for item in items
+        ]
+
+    def _batch_call(self, event, listener, guarded, args, kwargs, call=None):
+        call = call or self._call
+        if guarded:
+            return self._guarded_call(event, listener, args, kwargs, call)
+        return call(event, listener, args, kwargs)
+
+    def _call_batch(self, event, listener, args, kwargs):
+        results = self._call(event, listener, args, kwargs)
+        items = args[0]
+        if len(results) != len(items):
+            raise PluginError(
+                f"Batch listener {_callable_name(listener.callback)} of {event} "
+                f"returned {len(results)} results for {len(items)} items."
+            )
+        return results
+
+    def start_recording(self, path):
+        """Records all emitted events with the shape of their arguments and
+        their duration to a file, one JSON document per line. If the path
+        ends with ``.gz`` the file is gzip compressed. The recording can be
+        replayed against another set of plugins with :func:`replay_events`.
+        """
+        self.stop_recording()
+        self._recorder = _EventRecorder(path)
+
+    def stop_recording(self):
+        """Stops recording the emitted events and closes the file."""
+        recorder, self._recorder = self._recorder, None
+        if recorder is not None:
+            recorder.close()
+
+    @contextmanager
+    def owner(self, identifier):
+        """Attributes all listeners connected inside the ``with`` block to
+        the plugin with the given identifier. The :class:`PluginManager` does
+        this while running the setup of a plugin.
+        """
+        previous = self._current_owner
+        self._current_owner = identifier
+        try:
+            yield
+        finally:
+            self._current_owner = previous
+
+    def owner_of(self, event, callback):
+        """Returns the identifier of the plugin which connected the callback
+        to the event or ``None``.
+        """
+        listener = self._find(event, callback)
+        return listener.owner if listener is not None else None
+
+    def set_budget(self, event, budget: float | None):
+        """Sets the latency budget of an event in seconds. Once the budget
+        is spent, the remaining low priority listeners are skipped. Passing
+        ``None`` removes the budget.
+        """
+        event = sys.intern(event)
+        if budget is None:
+            self._budgets.pop(event, None)
+        else:
+            self._budgets[event] = budget
+        self._update_plain(event)
+
+    def configure_breakers(
+        self,
+        threshold: int | None = 5,
+        slow_call: float | None = None,
+        cooldown: float = 30.0,
+    ):
+        """Enables the circuit breakers of the listeners. If a listener
+        fails `threshold` times in a row, either by raising an exception or
+        by taking longer than `slow_call` seconds, it is bypassed for
+        `cooldown` seconds. Afterwards it is tried once again and either
+        recovers or is bypassed for another cool-down period.
+
+        While the circuit breakers are enabled, an exception raised by a
+        listener is logged and the listener doesn't contribute to the
+        results instead of breaking the whole emit. Passing ``None`` as
+        `threshold` disables the circuit breakers.
+        """
+        self.breaker_threshold = threshold
+        self.breaker_slow_call = slow_call
+        self.breaker_cooldown = cooldown
+        for listeners in self._listeners.values():
+            for listener in listeners:
+                listener.breaker = None
+
+    def breaker_states(self):
+        """Returns the state of the circuit breakers grouped by the
+        identifier of the plugin owning the listener. Listeners which are
+        not owned by a plugin are grouped under ``None``.
+        """
+        states: dict[str | None, list[dict]] = {}
+        for event, listeners in self._listeners.items():
+            for listener in listeners:
+                breaker = listener.breaker
+                if breaker is None:
+                    continue
+                states.setdefault(listener.owner, []).append(
+                    {
+                        "event": event,
+                        "listener": _callable_name(listener.callback),
+                        "state": breaker.state,
+                        "failures": breaker.failures,
+                        "trips": breaker.trips,
+                    }
+                )
+        return states
+
+    def _allowed(self, listener, budget, start):
+        if (
+            budget is not None
+            and listener.low_priority
+            and time.perf_counter() - start > budget
+        ):
+            return False
+        breaker = listener.breaker
+        return breaker is None or breaker.allow()
+
+    def _breaker(self, listener):
+        if listener.breaker is None:
+            listener.breaker = _CircuitBreaker(self)
+        return listener.breaker
+
+    def _guarded_call(self, event, listener, args, kwargs, call=None):
+        call = call or self._call
+        if self.breaker_threshold is None:
+            return call(event, listener, args, kwargs)
+
+        breaker = self._breaker(listener)
+        start = time.perf_counter()
+        try:
+            rv = call(event, listener, args, kwargs)
+        except Exception:
+            log.exception(
+                "Listener %s of %s failed.", _callable_name(listener.callback), event
+            )
+            breaker.record(failed=True)
+            return _skipped
+
+        slow = self.breaker_slow_call
+        breaker.record(failed=slow is not None and time.perf_counter() - start > slow)
+        return rv
+
+    @contextmanager
+    def trace(self, name="trace"):
+        """Records the call tree of all events emitted inside the ``with``
+        block, including events emitted by listeners. The finished
+        :class:`EventTrace` is appended to :attr:`traces`::
+
+            with event_manager.trace("index") as trace:
+                emit_event("before-data-rendered", data)
+            print(trace.to_collapsed())
+        """
+        trace = EventTrace(name)
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            _current_trace.reset(token)
+            trace.finish()
+            self.traces.append(trace)
+
+    def start_request_trace(self):
+        """Starts tracing the current request if it is sampled. Registered
+        as ``before_request`` function by the :class:`PluginManager`.
+        """
+        if not self.trace_sample_rate or random.random() >= self.trace_sample_rate:
+            return
+        trace = EventTrace(f"{request.method} {request.path}")
+        g._flask_plugins_trace = (trace, _current_trace.set(trace))
+
+    def finish_request_trace(self, exc=None):
+        """Finishes the trace of the current request if there is one."""
+        rv = g.pop("_flask_plugins_trace", None)
+        if rv is None:
+            return
+        trace, token = rv
+        try:
+            _current_trace.reset(token)
+        except ValueError:
+            # The token was created in a different context
+            _current_trace.set(None)
+        trace.finish()
+        self.traces.append(trace)
+
+    def configure_pool(
+        self,
+        max_workers: int | None = None,
+        timeout: float | None = None,
+        max_pending: int | None = None,
+        warm: bool = False,
+        mp_context=None,
+    ):
+        """Configures the process pool for offloaded listeners. A running
+        pool is shut down and re-created on the next use.
+
+        :param max_workers: The number of worker processes. Defaults to the
+                            number of CPUs.
+        :param timeout: Seconds to wait for an offloaded listener before a
+                        ``TimeoutError`` is raised.
+        :param max_pending: The number of offloaded calls which may be
+                            queued. If the pool is saturated, listeners are
+                            executed inline.
+        :param warm: Start all worker processes right away instead of on
+                     first use.
+        :param mp_context: The :mod:`multiprocessing` context used to start
+                           the workers.
+        """
+        self.shutdown_pool()
+        self._pool_options = {"max_workers": max_workers, "mp_context": mp_context}
+        self.pool_timeout = timeout
+        if max_pending is not None:
+            self.pool_max_pending = max_pending
+        else:
+            self.pool_max_pending = (max_workers or os.cpu_count() or 1) * 2
+        self._pool_warm = warm
+        if warm:
+            self.start_pool()
+
+    def start_pool(self):
+        """Starts the process pool of the current process. If the pool is
+        configured to be warm, all of its worker processes are started.
+        """
+        pid = os.getpid()
+        with self._pool_lock:
+            pool = self._pool
+            if pool is not None and self._pool_pid == pid:
+                return pool
+            # A pool inherited from the parent process is unusable
+            pool = self._pool = ProcessPoolExecutor(**self._pool_options)
+            self._pool_pid = pid
+            self._pool_pending = 0
+        if self._pool_warm:
+            for f in [pool.submit(os.getpid) for _ in range(pool._max_workers)]:
+                f.result()
+        return pool
+
+    def shutdown_pool(self, wait=True):
+        """Shuts down the process pool of the current process."""
+        with self._pool_lock:
+            pool, pid = self._pool, self._pool_pid
+            self._pool = None
+            self._pool_pid = None
+        if pool is not None and pid == os.getpid():
+            pool.shutdown(wait=wait)
+
+    def submit(self, callback, *args, **kwargs):
+        """Submits a call of the callback to the process pool. Returns
+        ``None`` if the call can't be offloaded because the arguments aren't
+        picklable or the pool is saturated.
+        """
+        try:
+            payload = pickle.dumps((callback, args, kwargs))
+        except Exception:
+            return None
+
+        pool = self.start_pool()
+        with self._pool_lock:
+            if self._pool_pending >= self.pool_max_pending:
+                return None
+            self._pool_pending += 1
+
+        try:
+            future = pool.submit(_call_pickled, payload)
+        except BrokenProcessPool:
+            with self._pool_lock:
+                if self._pool is pool:
+                    self._pool = None
+                self._pool_pending -= 1
+            return None
+        future.add_done_callback(self._pool_done)
+        return _PoolFuture(future)
+
+    def _pool_done(self, future):
+        with self._pool_lock:
+            self._pool_pending -= 1
+
+    def freeze(self):
+        """Turns the listener tables into immutable tuples. This is done
+        before forking worker processes so the tables are never written to
+        again and can be shared between the workers. Connecting or removing
+        a listener afterwards copies the affected table only.
+        """
+        for event, listeners in self._listeners.items():
+            self._listeners[event] = tuple(listeners)
+
+    def _thaw(self, event):
+        listeners = self._listeners.get(event)
+        if isinstance(listeners, tuple):
+            self._listeners[event] = deque(listeners)
 
     def iter(self, event):
-        """Return an iterator for all listeners of a given name."""
+        """Return an iterator for all listeners of a given name. If a
+        :attr:`mask_loader` is set, only the listeners of plugins enabled
+        in the returned mask and listeners not owned by any plugin are
+        returned. Listeners scoped to endpoints or blueprints are only
+        returned while handling a request to one of them.
+
+        The filtered listeners are cached per event, mask and endpoint.
+        """
+        plain = self._plain.get(event)
+        if plain is not None and (
+            self.mask_loader is None or self.mask_loader() is None
+        ):
+            return iter(plain)
+        return (listener.callback for listener in self._iter(event))
+
+    def _iter(self, event):
+        # Like iter() but returns the _Listener records
         if event not in self._listeners:
             return iter(())
-        return iter(self._listeners[event])
+        mask = self.mask_loader() if self.mask_loader is not None else None
+        endpoint = None
+        scoped = event in self._scoped_events
+        if scoped and has_request_context():
+            endpoint = request.endpoint
+        if mask is None and not scoped:
+            return iter(self._listeners[event])
+
+        key = (event, mask, endpoint)
+        listeners = self._dispatch_cache.get(key)
+        if listeners is None:
+            listeners = self._dispatch_cache[key] = tuple(
+                listener
+                for listener in self._listeners[event]
+                if (mask is None or self._in_mask(listener, mask))
+                and self._in_scope(listener, endpoint)
+            )
+        return iter(listeners)
+
+    def _in_scope(self, listener, endpoint):
+        scope = listener.scope
+        if scope is None:
+            return True
+        if endpoint is None:
+            return False
+        endpoints, blueprints = scope
+        if endpoint in endpoints:
+            return True
+        # "parent.child.index" is part of "parent.child" and "parent"
+        parts = endpoint.split(".")[:-1]
+        return any(".".join(parts[:i]) in blueprints for i in range(1, len(parts) + 1))
+
+    def _in_mask(self, listener, mask):
+        owner = listener.owner
+        if owner is None or owner not in self._owner_bits:
+            return True
+        return bool(mask >> self._owner_bits[owner] & 1)
 
     def template_emit(self, event, *args, **kwargs):
         """Emits events for the template context."""
-        results = []
-        for f in self.iter(event):
-            rv = f(*args, **kwargs)
-            if rv is not None:
-                results.append(rv)
+        plain = self._plain_listeners(event)
+        if plain is None:
+            results = [rv for rv in self.emit(event, *args, **kwargs) if rv is not None]
+        else:
+            results = []
+            for f in plain:
+                rv = f(*args, **kwargs)
+                if rv is not None:
+                    results.append(rv)
         return Markup(TemplateEventResult(results))
 
 
+class EmitExtension(Extension):
+    """A Jinja extension providing the ``{% emit %}`` tag. It emits an event
+    just like the ``emit_event`` function does::
+
+        {% emit "tmpl_before_content" %}
+        {% emit "tmpl_post_footer", post %}
+
+    The output of listeners connected with ``static=True`` is folded into
+    the compiled template and only the other listeners are called when the
+    template is rendered. Static listeners are always called without
+    arguments, also if the output can't be folded. If the listeners of a
+    folded event change, the templates using it are removed from the
+    template cache and compiled again.
+
+    The extension is added to the Jinja environment of the application by
+    the :class:`PluginManager`.
+    """
+
+    tags = {"emit"}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(plugin_event_manager=None)
+        # The names of the templates which folded an event
+        self._folded: dict[str, set[str | None]] = {}
+        self._watching = None
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        event_node = parser.parse_expression()
+        args = []
+        while parser.stream.skip_if("comma"):
+            args.append(parser.parse_expression())
+        if not isinstance(event_node, nodes.Const) or not isinstance(
+            event_node.value, str
+        ):
+            raise TemplateSyntaxError(
+                "The event name of emit has to be a string literal.",
+                lineno,
+                parser.name,
+                parser.filename,
+            )
+
+        runtime = [nodes.Output([self.call_method("_emit", [event_node, *args])])]
+        em = self.environment.plugin_event_manager
+        if em is None:
+            return runtime[0].set_lineno(lineno)
+
+        event = event_node.value
+        if self._watching is not em:
+            em.watch(self._invalidate)
+            self._watching = em
+
+        body = []
+        for position, listener in enumerate(list(em._listeners.get(event, ()))):
+            if listener.static:
+                rv = listener.callback()
+                if rv is not None:
+                    body.append(nodes.TemplateData(str(rv)))
+            else:
+                body.append(
+                    self.call_method(
+                        "_emit_listener",
+                        [nodes.Const(event), nodes.Const(position), nodes.List(args)],
+                    )
+                )
+        self._folded.setdefault(event, set()).add(parser.name)
+
+        # The folded output is only used while it is up to date and no
+        # listeners are filtered per request
+        test = self.call_method(
+            "_is_foldable", [nodes.Const(event), nodes.Const(em.version(event))]
+        )
+        folded = [nodes.Output(body)] if body else []
+        return nodes.If(test, folded, [], runtime).set_lineno(lineno)
+
+    def _invalidate(self, event):
+        names = self._folded.pop(event, None)
+        cache = self.environment.cache
+        if not names or cache is None:
+            return
+        for key in list(cache.keys()):
+            if key[1] in names:
+                try:
+                    del cache[key]
+                except KeyError:
+                    pass
+
+    def _emit(self, event, *args):
+        em = self.environment.plugin_event_manager
+        if em is None:
+            return ""
+        return em.template_emit(event, *args)
+
+    def _is_foldable(self, event, version):
+        em = self.environment.plugin_event_manager
+        return em.version(event) == version and em.can_fold(event)
+
+    def _emit_listener(self, event, position, args):
+        em = self.environment.plugin_event_manager
+        rv = em._call(event, em._listeners[event][position], tuple(args), {})
+        if rv is None:
+            return ""
+        return Markup(rv)
+
+
+def _write_atomic(path, content):
+    # Concurrent readers, e.g. other workers serving the assets, see either
+    # the old or the new file but never a partially written one
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _remove_url_rules(app, rule_ids):
+    # Werkzeug can't remove rules from a map, so the map is built again
+    # with the remaining rules
+    old = app.url_map
+    remaining = []
+    for rule in old.iter_rules():
+        if id(rule) in rule_ids:
+            continue
+        empty = rule.empty()
+        empty.provide_automatic_options = getattr(
+            rule, "provide_automatic_options", False
+        )
+        remaining.append(empty)
+
+    url_map = app.url_map_class(
+        remaining,
+        default_subdomain=old.default_subdomain,
+        strict_slashes=old.strict_slashes,
+        merge_slashes=old.merge_slashes,
+        redirect_defaults=old.redirect_defaults,
+        converters=old.converters,
+        sort_parameters=old.sort_parameters,
+        sort_key=old.sort_key,
+        host_matching=old.host_matching,
+    )
+    app.url_map = url_map
+
+
+def _take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+
+
+class _TraceFrame:
+    __slots__ = ("name", "start", "end", "children")
+
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.end = start
+        self.children = []
+
+
+class EventTrace:
+    """The recorded call tree of emitted events and their listeners. Events
+    are recorded as ``emit <event>`` frames and the listeners of an event
+    as its children.
+    """
+
+    def __init__(self, name: str):
+        #: The name of the trace, e.g. the request.
+        self.name = name
+
+        #: The root frame of the call tree.
+        self.root = _TraceFrame(name, time.perf_counter())
+        self._stack = [self.root]
+
+    @contextmanager
+    def frame(self, name):
+        """Records a frame nested in the currently active frame."""
+        frame = _TraceFrame(name, time.perf_counter())
+        self._stack[-1].children.append(frame)
+        self._stack.append(frame)
+        try:
+            yield frame
+        finally:
+            frame.end = time.perf_counter()
+            self._stack.pop()
+
+    def finish(self):
+        """Ends the root frame of the trace."""
+        self.root.end = time.perf_counter()
+
+    def to_collapsed(self) -> str:
+        """Exports the call tree in the collapsed stack format which is
+        understood by ``flamegraph.pl`` and most flame graph viewers. The
+        values are the self times in microseconds.
+        """
+        lines = []
+
+        def walk(frame, stack):
+            stack = stack + [frame.name.replace(";", ":")]
+            child_time = sum(c.end - c.start for c in frame.children)
+            self_time = round((frame.end - frame.start - child_time) * 1e6)
+            lines.append(f"{';'.join(stack)} {max(self_time, 0)}")
+            for child in frame.children:
+                walk(child, stack)
+
+        walk(self.root, [])
+        return "\n".join(lines) + "\n"
+
+    def to_speedscope(self) -> dict:
+        """Exports the call tree as speedscope JSON document, which can be
+        opened on https://www.speedscope.app.
+        """
+        frames: list[dict[str, str]] = []
+        frame_index: dict[str, int] = {}
+        events: list[dict[str, object]] = []
+        origin = self.root.start
+
+        def walk(frame):
+            index = frame_index.get(frame.name)
+            if index is None:
+                index = frame_index[frame.name] = len(frames)
+                frames.append({"name": frame.name})
+            at = (frame.start - origin) * 1000
+            events.append({"type": "O", "frame": index, "at": at})
+            for child in frame.children:
+                walk(child)
+            at = (frame.end - origin) * 1000
+            events.append({"type": "C", "frame": index, "at": at})
+
+        walk(self.root)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "evented",
+                    "name": self.name,
+                    "unit": "milliseconds",
+                    "startValue": 0,
+                    "endValue": (self.root.end - origin) * 1000,
+                    "events": events,
+                }
+            ],
+            "name": self.name,
+            "exporter": "flask-plugins",
+        }
+
+
+_current_trace: ContextVar[EventTrace | None] = ContextVar(
+    "flask_plugins_trace", default=None
+)
+
+
+class _EventRecorder:
+    # Writes one line per emitted event: the kind ("e" for emit and "b" for
+    # emit_batch), the event, the shapes of the positional and keyword
+    # arguments, the duration in microseconds and the nesting depth.
+    #
+    # The file is opened on the first write of each process and closed
+    # before forking, so the children never inherit an open stream. Forked
+    # processes, e.g. preloaded workers, write to their own file with the
+    # process id added to the path; the parent appends a new gzip member.
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.pid = os.getpid()
+        self.fd = None
+        self.fd_pid = None
+        self.closed = False
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+        _recorders.add(self)
+
+    def _open(self):
+        path = self.path
+        pid = os.getpid()
+        if pid != self.pid:
+            if path.endswith(".gz"):
+                path = f"{path[:-3]}.{pid}.gz"
+            else:
+                path = f"{path}.{pid}"
+        self.fd = gzip.open(path, "at") if path.endswith(".gz") else open(path, "a")
+        self.fd_pid = pid
+
+    @contextmanager
+    def record(self, kind, event, args, kwargs):
+        depth = _recording_depth.get()
+        token = _recording_depth.set(depth + 1)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = round((time.perf_counter() - start) * 1e6)
+            _recording_depth.reset(token)
+            line = json.dumps(
+                [
+                    kind,
+                    event,
+                    [_shape(a) for a in args],
+                    {k: _shape(v) for k, v in kwargs.items()},
+                    duration,
+                    depth,
+                ],
+                separators=(",", ":"),
+            )
+            with self.lock:
+                if not self.closed:
+                    if self.fd_pid != os.getpid():
+                        self._open()
+                    self.fd.write(line + "\n")
+
+    def close(self):
+        atexit.unregister(self.close)
+        with self.lock:
+            self.closed = True
+            self._close_file()
+
+    def _close_file(self):
+        if self.fd is not None and self.fd_pid == os.getpid():
+            self.fd.close()
+        self.fd = None
+        self.fd_pid = None
+
+
+# All active recorders, their files are closed before forking
+_recorders: weakref.WeakSet[_EventRecorder] = weakref.WeakSet()
+
+
+def _close_recorder_files():
+    for recorder in list(_recorders):
+        with recorder.lock:
+            recorder._close_file()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=_close_recorder_files)
+
+
+_recording_depth: ContextVar[int] = ContextVar("flask_plugins_depth", default=0)
+
+
+def _shape(value, depth=0):
+    """Returns a JSON serializable description of the type and size of a
+    value from which a similar value can be built again.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (bool, int, float)):
+        return [type(value).__name__]
+    if isinstance(value, str):
+        return ["str", len(value)]
+    if isinstance(value, (list, tuple, set)):
+        item = _shape(next(iter(value)), depth + 1) if value and depth < 3 else None
+        return ["list", len(value), item]
+    if isinstance(value, dict) and depth < 3:
+        return ["dict", {str(k): _shape(v, depth + 1) for k, v in value.items()}]
+    cls = type(value)
+    return ["obj", f"{cls.__module__}.{cls.__qualname__}"]
+
+
+def _build(shape, factories):
+    if shape is None:
+        return None
+    kind = shape[0]
+    if kind in ("bool", "int", "float"):
+        return {"bool": False, "int": 0, "float": 0.0}[kind]
+    if kind == "str":
+        return "x" * shape[1]
+    if kind == "list":
+        return [_build(shape[2], factories) for _ in range(shape[1])]
+    if kind == "dict":
+        return {k: _build(v, factories) for k, v in shape[1].items()}
+    factory = factories.get(shape[1])
+    return factory() if factory is not None else None
+
+
+def replay_events(path, event_manager=None, factories=None, include_nested=False):
+    """Replays a recording made with :meth:`EventManager.start_recording`
+    against the currently loaded plugins and returns a report comparing
+    the recorded and the replayed latencies and throughput.
+
+    The arguments are rebuilt from their recorded shapes: strings of the
+    same length, lists with the same number of items and so on. Objects of
+    other types are ``None`` unless a factory is given for them. Events
+    emitted by listeners are replayed by their listeners again, so only the
+    outermost events are replayed unless `include_nested` is ``True``.
+
+    :param path: The recording.
+    :param event_manager: The event manager to use. Defaults to the event
+                          manager of the current application.
+    :param factories: A dictionary mapping the full names of classes, like
+                      ``"myapp.models.Post"``, to callables returning a
+                      sample object.
+    """
+    em = event_manager if event_manager is not None else _get_em()
+    factories = factories or {}
+
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, "rt") as fd:
+        records = [json.loads(line) for line in fd if line.strip()]
+
+    recorded: dict[str, list[float]] = {}
+    replayed: dict[str, list[float]] = {}
+    total = 0.0
+    for kind, event, arg_shapes, kwarg_shapes, duration, depth in records:
+        if depth and not include_nested:
+            continue
+        args = [_build(shape, factories) for shape in arg_shapes]
+        kwargs = {k: _build(shape, factories) for k, shape in kwarg_shapes.items()}
+        emit = em.emit_batch if kind == "b" else em.emit
+
+        start = time.perf_counter()
+        emit(event, *args, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        total += elapsed
+        recorded.setdefault(event, []).append(duration / 1e6)
+        replayed.setdefault(event, []).append(elapsed)
+
+    events = {}
+    for event, before in recorded.items():
+        after = replayed[event]
+        before_mean = sum(before) / len(before)
+        after_mean = sum(after) / len(after)
+        events[event] = {
+            "count": len(before),
+            "recorded_mean": before_mean,
+            "replayed_mean": after_mean,
+            "recorded_p95": _percentile(before, 0.95),
+            "replayed_p95": _percentile(after, 0.95),
+            "change": after_mean / before_mean - 1 if before_mean else None,
+        }
+
+    count = sum(len(v) for v in replayed.values())
+    recorded_total = sum(sum(v) for v in recorded.values())
+    return {
+        "count": count,
+        "recorded_throughput": count / recorded_total if recorded_total else None,
+        "replayed_throughput": count / total if total else None,
+        "events": events,
+    }
+
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile))]
+
+
+def _as_frozenset(value):
+    if value is None:
+        return frozenset()
+    if isinstance(value, str):
+        return frozenset([value])
+    return frozenset(value)
+
+
+def _callable_name(f):
+    module = getattr(f, "__module__", None)
+    name = getattr(f, "__qualname__", None) or repr(f)
+    return f"{module}.{name}" if module else name
+
+
+class _Listener:
+    # A callback connected to an event together with the options it was
+    # connected with. Connecting the same callback twice creates two
+    # independent listeners.
+    __slots__ = (
+        "callback",
+        "pure",
+        "offload",
+        "low_priority",
+        "scope",
+        "static",
+        "batch",
+        "owner",
+        "breaker",
+    )
+
+    def __init__(
+        self,
+        callback,
+        pure=False,
+        offload=False,
+        low_priority=False,
+        scope=None,
+        static=False,
+        batch=False,
+        owner=None,
+    ):
+        self.callback = callback
+        self.pure = pure
+        self.offload = offload
+        self.low_priority = low_priority
+        # The endpoints and blueprints the listener is scoped to
+        self.scope = scope
+        self.static = static
+        self.batch = batch
+        # The identifier of the plugin which connected the listener
+        self.owner = owner
+        self.breaker = None
+
+
+class _CircuitBreaker:
+    # The circuit breaker of a single listener. It is "closed" while the
+    # listener works, "open" while the listener is bypassed and "half-open"
+    # when the cool-down is over and the next call decides.
+    __slots__ = ("manager", "failures", "trips", "opened_at")
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.manager.breaker_cooldown:
+            return "open"
+        return "half-open"
+
+    def allow(self):
+        return self.state != "open"
+
+    def record(self, failed):
+        if not failed:
+            self.failures = 0
+            self.opened_at = None
+            return
+
+        self.failures += 1
+        if (
+            self.opened_at is not None
+            or self.failures >= self.manager.breaker_threshold
+        ):
+            self.trips += 1
+            self.opened_at = time.monotonic()
+
+
+# Marks a listener call which doesn't contribute to the results
+_skipped = object()
+
+
+class _PoolFuture:
+    # Wraps the futures of offloaded listeners, only the result is exposed
+    __slots__ = ("future",)
+
+    def __init__(self, future):
+        self.future = future
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+
+def _call_pickled(payload):
+    callback, args, kwargs = pickle.loads(payload)
+    return callback(*args, **kwargs)
+
+
 class TemplateEventResult(list):
     """A list subclass for results returned by the event listener that
     concatenates the results if converted to string, otherwise it works
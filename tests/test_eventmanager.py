@@ -1,9 +1,23 @@
+import gzip
+import json
+import operator
+import os
+import threading
+import time
+
+import flask
+import pytest
+from jinja2 import DictLoader
+from jinja2 import TemplateSyntaxError
 from markupsafe import Markup
 
 from flask_plugins import connect_event
+from flask_plugins import emit_batch
 from flask_plugins import emit_event
 from flask_plugins import EventManager
 from flask_plugins import iter_listeners
+from flask_plugins import PluginError
+from flask_plugins import replay_events
 from tests.test_pluginmanager import PluginManager
 
 
@@ -81,3 +95,506 @@ def test_helper_methods(app):
 
     assert len(events) == 1
     assert emit_result == ["Fred"]
+
+
+def test_event_manager_pure_listener_memoized(app):
+    calls = []
+
+    def pure_cb(name):
+        calls.append(name)
+        return f"Hello {name}"
+
+    event_manager = EventManager()
+    event_manager.connect("test-event", pure_cb, pure=True)
+    event_manager.connect("test-event", str.upper)
+
+    with app.test_request_context():
+        assert event_manager.emit("test-event", "Fred") == ["Hello Fred", "FRED"]
+        assert event_manager.emit("test-event", "Fred") == ["Hello Fred", "FRED"]
+        assert event_manager.emit("test-event", "Bob") == ["Hello Bob", "BOB"]
+
+    with app.test_request_context():
+        event_manager.emit("test-event", "Fred")
+
+    assert calls == ["Fred", "Bob", "Fred"]
+    assert event_manager.memo_stats() == {"test-event": {"hits": 1, "misses": 3}}
+
+
+def test_event_manager_pure_event(app):
+    calls = []
+
+    def listener(value=None, x=None):
+        calls.append(value if x is None else x)
+
+    event_manager = EventManager()
+    event_manager.connect("test-event", listener)
+    event_manager.set_pure("test-event")
+
+    with app.test_request_context():
+        event_manager.template_emit("test-event", 1)
+        event_manager.template_emit("test-event", 1)
+        # unhashable arguments are never memoized
+        event_manager.emit("test-event", [1])
+        event_manager.emit("test-event", [1])
+        event_manager.emit("test-event", x=[2])
+        event_manager.emit("test-event", x=[2])
+
+    # outside of a request everything is called
+    event_manager.emit("test-event", 1)
+
+    assert calls == [1, [1], [1], [2], [2], 1]
+
+
+def test_event_manager_plain_events():
+    event_manager = EventManager()
+    event_manager.connect("test-event", cb)
+    assert event_manager._plain["test-event"] == (cb,)
+    assert event_manager.emit("test-event") == ["Fred"]
+
+    event_manager.set_budget("test-event", 1.0)
+    assert "test-event" not in event_manager._plain
+    event_manager.set_budget("test-event", None)
+    event_manager.connect("test-event", cb, pure=True)
+    assert "test-event" not in event_manager._plain
+    event_manager.remove("test-event", cb)
+    assert "test-event" not in event_manager._plain
+    event_manager.remove("test-event", cb)
+    assert event_manager._plain["test-event"] == ()
+
+
+def test_event_manager_connect_twice():
+    def listener(*args):
+        return args
+
+    event_manager = EventManager()
+    event_manager.connect("test-event", listener, static=True)
+    event_manager.connect("test-event", listener)
+    assert event_manager.emit("test-event", 1) == [(), (1,)]
+
+    # the options of the remaining connection are kept
+    event_manager.remove("test-event", listener)
+    assert event_manager.emit("test-event", 1) == [(1,)]
+    assert not event_manager.is_static("test-event", listener)
+
+
+def test_event_manager_freeze():
+    event_manager = EventManager()
+    event_manager.connect("test-event", cb)
+    event_manager.connect("other-event", cb)
+    event_manager.freeze()
+
+    assert isinstance(event_manager._listeners["test-event"], tuple)
+    assert event_manager.emit("test-event") == ["Fred"]
+
+    # only the modified table is thawed
+    event_manager.connect("test-event", cb_before, "before")
+    assert list(event_manager.iter("test-event")) == [cb_before, cb]
+    assert isinstance(event_manager._listeners["other-event"], tuple)
+
+    event_manager.remove("other-event", cb)
+    assert list(event_manager.iter("other-event")) == []
+
+
+def test_event_manager_offload():
+    event_manager = EventManager()
+    event_manager.configure_pool(max_workers=1, timeout=10, warm=True)
+    try:
+        event_manager.connect("test-event", pow, offload=True)
+        event_manager.connect("test-event", max)
+        event_manager.connect("test-event", pow, offload=True)
+        assert event_manager.emit("test-event", 2, 10) == [1024, 10, 1024]
+        assert event_manager._pool_pending == 0
+    finally:
+        event_manager.shutdown_pool()
+
+
+def test_event_manager_offload_fallback():
+    event_manager = EventManager()
+    event_manager.configure_pool(max_workers=1, max_pending=0)
+    try:
+        # the pool is saturated
+        event_manager.connect("test-event", pow, offload=True)
+        assert event_manager.emit("test-event", 2, 3) == [8]
+        assert event_manager._pool is not None
+
+        # lambdas can't be pickled
+        event_manager.configure_pool(max_workers=1)
+        event_manager.connect("other-event", lambda: "inline", offload=True)
+        assert event_manager.emit("other-event") == ["inline"]
+        assert event_manager._pool is None
+    finally:
+        event_manager.shutdown_pool()
+
+
+def test_event_manager_start_pool_once():
+    event_manager = EventManager()
+    event_manager.configure_pool(max_workers=1)
+    barrier = threading.Barrier(8)
+    pools = []
+
+    def start():
+        barrier.wait()
+        pools.append(event_manager.start_pool())
+
+    threads = [threading.Thread(target=start) for _ in range(8)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(pools) == 8
+        assert all(pool is event_manager._pool for pool in pools)
+    finally:
+        event_manager.shutdown_pool()
+
+
+def test_event_manager_trace():
+    event_manager = EventManager()
+
+    def outer():
+        return event_manager.emit("inner-event")
+
+    event_manager.connect("outer-event", outer)
+    event_manager.connect("inner-event", cb)
+
+    with event_manager.trace("test") as trace:
+        assert event_manager.emit("outer-event") == [["Fred"]]
+
+    assert event_manager.traces[-1] is trace
+    stacks = [line.rsplit(" ", 1)[0] for line in trace.to_collapsed().splitlines()]
+    outer_name = f"{__name__}.{outer.__qualname__}"
+    assert stacks == [
+        "test",
+        "test;emit outer-event",
+        f"test;emit outer-event;{outer_name}",
+        f"test;emit outer-event;{outer_name};emit inner-event",
+        f"test;emit outer-event;{outer_name};emit inner-event;{__name__}.cb",
+    ]
+
+    document = trace.to_speedscope()
+    assert len(document["shared"]["frames"]) == 5
+    events = document["profiles"][0]["events"]
+    assert [e["type"] for e in events] == ["O"] * 5 + ["C"] * 5
+
+    # nothing is recorded outside of a trace
+    event_manager.emit("outer-event")
+    assert len(event_manager.traces) == 1
+
+
+def test_request_trace_sampling(app):
+    plugin_manager = PluginManager(app)
+    event_manager = plugin_manager._event_manager
+
+    @app.route("/")
+    def index():
+        return str(emit_event("test-event"))
+
+    with app.app_context():
+        connect_event("test-event", cb)
+
+    app.test_client().get("/")
+    assert len(event_manager.traces) == 0
+
+    event_manager.trace_sample_rate = 1.0
+    app.test_client().get("/")
+    assert len(event_manager.traces) == 1
+    assert event_manager.traces[0].name == "GET /"
+    assert "GET /;emit test-event" in event_manager.traces[0].to_collapsed()
+
+
+def test_event_manager_budget():
+    event_manager = EventManager()
+
+    def slow():
+        time.sleep(0.02)
+        return "slow"
+
+    event_manager.connect("test-event", slow)
+    event_manager.connect("test-event", cb, low_priority=True)
+    event_manager.connect("test-event", str)
+
+    assert event_manager.emit("test-event") == ["slow", "Fred", ""]
+
+    event_manager.set_budget("test-event", 0.01)
+    # only the low priority listeners are skipped
+    assert event_manager.emit("test-event") == ["slow", ""]
+
+    event_manager.set_budget("test-event", None)
+    assert event_manager.emit("test-event") == ["slow", "Fred", ""]
+
+
+def test_event_manager_circuit_breaker():
+    event_manager = EventManager()
+    calls = []
+
+    def broken():
+        calls.append(True)
+        raise ValueError("broken")
+
+    with event_manager.owner("test1"):
+        event_manager.connect("test-event", broken)
+    event_manager.connect("test-event", cb)
+    assert event_manager.owner_of("test-event", broken) == "test1"
+
+    with pytest.raises(ValueError):
+        event_manager.emit("test-event")
+
+    event_manager.configure_breakers(threshold=2, cooldown=60)
+    assert event_manager.emit("test-event") == ["Fred"]
+    assert event_manager.breaker_states()["test1"][0]["state"] == "closed"
+    assert event_manager.emit("test-event") == ["Fred"]
+    assert event_manager.emit("test-event") == ["Fred"]
+    assert len(calls) == 3
+
+    state = event_manager.breaker_states()["test1"][0]
+    assert state["event"] == "test-event"
+    assert state["state"] == "open"
+    assert state["trips"] == 1
+
+    # the listener is tried again after the cool-down
+    event_manager.breaker_cooldown = 0
+    assert event_manager.emit("test-event") == ["Fred"]
+    assert len(calls) == 4
+    assert event_manager.breaker_states()["test1"][0]["trips"] == 2
+
+
+def test_event_manager_circuit_breaker_offload():
+    event_manager = EventManager()
+    event_manager.configure_pool(max_workers=1, timeout=10)
+    event_manager.configure_breakers(threshold=1, cooldown=60)
+    try:
+        event_manager.connect("test-event", operator.truediv, offload=True)
+        event_manager.connect("test-event", max)
+        assert event_manager.emit("test-event", 1, 0) == [1]
+
+        states = {
+            state["listener"]: state["state"]
+            for state in event_manager.breaker_states()[None]
+        }
+        assert states == {"_operator.truediv": "open", "builtins.max": "closed"}
+        assert event_manager.emit("test-event", 1, 0) == [1]
+    finally:
+        event_manager.shutdown_pool()
+
+
+def test_event_manager_scoped_listeners(app):
+    admin = flask.Blueprint("admin", __name__)
+    admin.route("/")(lambda: "admin")
+    app.register_blueprint(admin, url_prefix="/admin")
+    app.route("/")(lambda: "index")
+    app.route("/about", endpoint="about")(lambda: "about")
+
+    def admin_listener():
+        return "admin"
+
+    def about_listener():
+        return "about"
+
+    event_manager = EventManager()
+    event_manager.connect("test-event", cb)
+    event_manager.connect("test-event", admin_listener, blueprints="admin")
+    event_manager.connect("test-event", about_listener, endpoints=["about"])
+
+    with app.test_request_context("/admin/"):
+        assert event_manager.emit("test-event") == ["Fred", "admin"]
+    with app.test_request_context("/about"):
+        assert event_manager.emit("test-event") == ["Fred", "about"]
+    with app.test_request_context("/"):
+        assert event_manager.emit("test-event") == ["Fred"]
+    assert event_manager.emit("test-event") == ["Fred"]
+
+    event_manager.remove("test-event", about_listener)
+    with app.test_request_context("/about"):
+        assert event_manager.emit("test-event") == ["Fred"]
+
+
+def test_emit_extension(app):
+    PluginManager(app)
+    calls = []
+
+    def static_listener():
+        calls.append("static")
+        return Markup("<b>static</b>")
+
+    def dynamic_listener(name):
+        calls.append("dynamic")
+        return f"<i>{name}</i>"
+
+    app.jinja_env.loader = DictLoader(
+        {"page.html": '{% emit "test-event", name %}|{% emit "other-event" %}'}
+    )
+    with app.test_request_context():
+        connect_event("test-event", static_listener, static=True)
+        connect_event("test-event", dynamic_listener)
+
+        assert (
+            flask.render_template("page.html", name="Fred")
+            == "<b>static</b><i>Fred</i>|"
+        )
+        assert (
+            flask.render_template("page.html", name="Bob") == "<b>static</b><i>Bob</i>|"
+        )
+        # the static listener was called once when compiling the template
+        assert calls == ["static", "dynamic", "dynamic"]
+
+        # the template is compiled again when the listeners change
+        connect_event("test-event", static_listener, "before", static=True)
+        assert (
+            flask.render_template("page.html", name="Fred")
+            == "<b>static</b><b>static</b><i>Fred</i>|"
+        )
+        assert calls.count("static") == 3
+
+
+def test_emit_extension_recorded_and_traced(app, tmp_path):
+    plugin_manager = PluginManager(app)
+    event_manager = plugin_manager._event_manager
+    app.jinja_env.loader = DictLoader({"page.html": '{% emit "test-event", "a" %}'})
+    path = tmp_path / "events.jsonl"
+
+    with app.test_request_context():
+        connect_event("test-event", cb, static=True)
+        assert flask.render_template("page.html") == "Fred"
+
+        # folded output bypasses emit, so it isn't used while recording
+        event_manager.start_recording(path)
+        assert flask.render_template("page.html") == "Fred"
+        event_manager.stop_recording()
+        with event_manager.trace() as trace:
+            assert flask.render_template("page.html") == "Fred"
+
+    with open(path) as fd:
+        assert [json.loads(line)[1] for line in fd] == ["test-event"]
+    assert "emit test-event" in trace.to_collapsed()
+
+
+def test_emit_extension_runtime_fallback(app):
+    plugin_manager = PluginManager(app)
+    app.route("/")(lambda: "index")
+    app.route("/about", endpoint="about")(lambda: "about")
+
+    def static_listener():
+        return "static"
+
+    template = '{% emit "test-event" %}'
+    with app.test_request_context("/"):
+        connect_event("test-event", static_listener, static=True)
+        connect_event("test-event", cb, endpoints="about")
+        assert flask.render_template_string(template) == "static"
+    with app.test_request_context("/about"):
+        assert flask.render_template_string(template) == "staticFred"
+
+    # static listeners are called without the arguments of the event
+    plugin_manager._event_manager.set_budget("other-event", 1.0)
+    template = '{% emit "other-event", "a" %}'
+    with app.test_request_context("/"):
+        connect_event("other-event", static_listener, static=True)
+        connect_event("other-event", str.upper)
+        assert flask.render_template_string(template) == "staticA"
+        assert emit_event("other-event", "b") == ["static", "B"]
+
+    # the event name has to be known when compiling
+    with pytest.raises(TemplateSyntaxError):
+        app.jinja_env.from_string("{% emit name %}")
+
+    assert plugin_manager._event_manager.can_fold("unknown-event")
+
+
+def test_event_manager_emit_batch(app):
+    batches = []
+
+    def batch_listener(posts, prefix):
+        batches.append(posts)
+        return [f"{prefix}{post}" for post in posts]
+
+    def broken_batch_listener(posts, prefix):
+        return []
+
+    def listener(post, prefix):
+        return post.upper()
+
+    plugin_manager = PluginManager(app)
+    with app.test_request_context():
+        connect_event("test-event", batch_listener, batch=True)
+        connect_event("test-event", listener)
+        assert emit_batch("test-event", ["a", "b"], "") == [["a", "A"], ["b", "B"]]
+        assert emit_batch("test-event", [], "") == []
+        assert emit_batch("other-event", ["a"], "") == [[]]
+        # listeners aren't called for empty batches
+        assert batches == [["a", "b"]]
+
+        connect_event("test-event", broken_batch_listener, batch=True)
+        with pytest.raises(PluginError):
+            emit_batch("test-event", ["a"], "")
+
+        # with circuit breakers the broken listener doesn't contribute
+        event_manager = plugin_manager._event_manager
+        event_manager.configure_breakers(threshold=2, cooldown=60)
+        for _ in range(2):
+            assert emit_batch("test-event", ["a"], "") == [["a", "A"]]
+        states = event_manager.breaker_states()[None]
+        assert [s["state"] for s in states if "broken" in s["listener"]] == ["open"]
+
+
+class Post:
+    pass
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_event_manager_record_forked(tmp_path):
+    path = tmp_path / "events.jsonl.gz"
+    event_manager = EventManager()
+    event_manager.connect("test-event", cb)
+    event_manager.start_recording(path)
+    event_manager.emit("test-event")
+
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        event_manager.emit("child-event")
+        event_manager.stop_recording()
+        os._exit(0)
+    os.waitpid(pid, 0)
+    event_manager.emit("test-event")
+    event_manager.stop_recording()
+
+    with gzip.open(path, "rt") as fd:
+        assert [json.loads(line)[1] for line in fd] == ["test-event"] * 2
+    with gzip.open(tmp_path / f"events.jsonl.{pid}.gz", "rt") as fd:
+        assert [json.loads(line)[1] for line in fd] == ["child-event"]
+
+
+def test_event_manager_record_and_replay(tmp_path):
+    path = tmp_path / "events.jsonl.gz"
+    received = []
+
+    def listener(title, posts, options=None, post=None):
+        received.append((title, posts, options, post))
+        return event_manager.emit("inner-event")
+
+    event_manager = EventManager()
+    event_manager.connect("test-event", listener)
+    event_manager.connect("inner-event", cb)
+    event_manager.connect("batch-event", lambda posts: posts, batch=True)
+
+    event_manager.start_recording(path)
+    event_manager.emit("test-event", "Hello", [1, 2], options={"a": 1.5}, post=Post())
+    event_manager.emit_batch("batch-event", ["a", "b", "c"])
+    event_manager.stop_recording()
+    # nothing is recorded afterwards
+    event_manager.emit("inner-event")
+
+    received.clear()
+    report = replay_events(
+        path,
+        event_manager=event_manager,
+        factories={f"{__name__}.Post": Post},
+    )
+
+    assert received[0][:3] == ("xxxxx", [0, 0], {"a": 0.0})
+    assert isinstance(received[0][3], Post)
+    assert report["count"] == 2
+    assert set(report["events"]) == {"test-event", "batch-event"}
+    assert report["events"]["test-event"]["count"] == 1
+
+    report = replay_events(path, event_manager=event_manager, include_nested=True)
+    assert set(report["events"]) == {"test-event", "inner-event", "batch-event"}
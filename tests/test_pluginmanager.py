@@ -1,13 +1,23 @@
+import gc
+import gzip
 import os
+import sys
+import tracemalloc
+import weakref
 
+import flask
 import pytest
 
+from flask_plugins import clear_discovery_cache
+from flask_plugins import emit_event
 from flask_plugins import get_all_plugins
 from flask_plugins import get_enabled_plugins
 from flask_plugins import get_plugin
 from flask_plugins import get_plugin_from_all
+from flask_plugins import Plugin
 from flask_plugins import PluginError
 from flask_plugins import PluginManager
+from flask_plugins import query_plugins
 
 
 def test_class_init(app):
@@ -134,3 +144,304 @@ def test_manager_enable_disable_logic(app, test1_plugin):
 
     plugin_manager.enable_plugins([test1_plugin])
     assert test1_plugin.enabled
+
+
+def test_query(app):
+    plugin_manager = PluginManager(app)
+
+    page = plugin_manager.query()
+    assert [p.identifier for p in page] == ["test1", "test2", "test3"]
+    assert page.total == 3
+
+    page = plugin_manager.query(enabled=True, order_by="name", reverse=True)
+    assert [p.identifier for p in page] == ["test2", "test1"]
+
+    page = plugin_manager.query(author="sh4nks", options=["settings"])
+    assert [p.identifier for p in page] == ["test2"]
+
+    assert plugin_manager.query(author="nobody").total == 0
+
+    with pytest.raises(ValueError):
+        plugin_manager.query(order_by="description")
+    with pytest.raises(ValueError):
+        plugin_manager.query(page=0)
+    with pytest.raises(ValueError):
+        plugin_manager.query(per_page=-1)
+
+
+def test_query_pagination(app):
+    PluginManager(app)
+    with app.test_request_context():
+        page = query_plugins(per_page=2, page=2)
+
+    assert [p.identifier for p in page] == ["test3"]
+    assert page.total == 3
+    assert page.pages == 2
+    assert page.has_prev and not page.has_next
+
+
+def test_query_enabled_index(app, test1_plugin):
+    plugin_manager = PluginManager(app)
+    test1_plugin = plugin_manager.all_plugins["test1"]
+
+    plugin_manager.disable_plugins([test1_plugin])
+    assert [p.identifier for p in plugin_manager.query(enabled=True)] == ["test2"]
+
+    plugin_manager.enable_plugins([test1_plugin])
+    assert plugin_manager.query(enabled=True).total == 2
+    assert "test1" in plugin_manager.plugins
+    assert plugin_manager.plugins["test1"].setup_called
+    assert plugin_manager.all_plugins["test1"] is plugin_manager.plugins["test1"]
+
+
+def test_startup_report(app):
+    plugin_manager = PluginManager(app, profile=True)
+    report = plugin_manager.startup_report()
+
+    assert {p["plugin"] for p in report["plugins"]} == {"test1", "test2", "test3"}
+    test1 = next(p for p in report["plugins"] if p["plugin"] == "test1")
+    assert set(test1["phases"]) == {"import", "load", "setup"}
+    assert set(report["phases"]) == {"import", "load", "setup"}
+
+    result = app.test_cli_runner().invoke(args=["plugins", "profile", "-n", "1"])
+    assert result.exit_code == 0
+    assert len(result.output.splitlines()) == 2
+
+
+def test_startup_report_disabled(app):
+    plugin_manager = PluginManager(app)
+    assert plugin_manager.startup_report() is None
+
+    result = app.test_cli_runner().invoke(args=["plugins", "profile"])
+    assert result.exit_code != 0
+
+
+def test_replay_command(app, tmp_path):
+    path = tmp_path / "events.jsonl"
+    plugin_manager = PluginManager(app)
+    event_manager = plugin_manager._event_manager
+    event_manager.connect("test-event", str.upper)
+    event_manager.start_recording(path)
+    event_manager.emit("test-event", "Fred")
+    event_manager.stop_recording()
+
+    result = app.test_cli_runner().invoke(args=["plugins", "replay", str(path)])
+    assert result.exit_code == 0
+    assert result.output.splitlines()[1].startswith("test-event")
+    assert "Replayed throughput" in result.output
+
+
+def test_preload(app, monkeypatch):
+    frozen = []
+    monkeypatch.setattr("gc.freeze", lambda: frozen.append(True))
+
+    plugin_manager = PluginManager(app)
+    plugin_manager.preload()
+
+    assert plugin_manager.preloaded
+    assert frozen == [True]
+    assert "license_text" in vars(plugin_manager.all_plugins["test1"])
+
+    plugin_manager.post_fork()
+
+
+def test_memory_report(app):
+    plugin_manager = PluginManager(app, trace_memory=True)
+    report = plugin_manager.memory_report()
+
+    assert {p["plugin"] for p in report} == {"test1", "test2", "test3"}
+    test1 = next(p for p in report if p["plugin"] == "test1")
+    assert test1["name"] == "Test One"
+    assert set(test1["phases"]) == {"import", "load", "setup"}
+    assert all(size > 0 for _, size in test1["phases"]["load"]["top"])
+
+    # tracing is only active during the startup
+    assert not tracemalloc.is_tracing()
+    assert PluginManager(app).memory_report() is None
+
+
+def test_shared_discovery(app, monkeypatch, test1_plugin):
+    clear_discovery_cache()
+    calls = []
+    discover = PluginManager._discover
+
+    def counting_discover(self, state):
+        calls.append(state)
+        return discover(self, state)
+
+    monkeypatch.setattr(PluginManager, "_discover", counting_discover)
+
+    plugin_manager = PluginManager(app)
+    other_manager = PluginManager(flask.Flask(__name__))
+    assert len(calls) == 1
+
+    # every app still gets its own plugin instances and event manager
+    plugin = plugin_manager.all_plugins["test1"]
+    other = other_manager.all_plugins["test1"]
+    assert plugin is not other
+    assert plugin.info == other.info and plugin.info is not other.info
+    assert plugin_manager._event_manager is not other_manager._event_manager
+
+    # disabling a plugin changes the state of the plugin folder
+    plugin_manager.disable_plugins([plugin])
+    PluginManager(flask.Flask(__name__))
+    assert len(calls) == 2
+
+    app.config["PLUGINS_SHARE_DISCOVERY"] = False
+    PluginManager(app)
+    assert len(calls) == 3
+
+
+def test_tenant_plugins(app):
+    plugin_manager = PluginManager(app)
+    event_manager = plugin_manager._event_manager
+
+    def test1_listener():
+        return "test1"
+
+    def test2_listener():
+        return "test2"
+
+    def app_listener():
+        return "app"
+
+    with event_manager.owner("test1"):
+        event_manager.connect("test-event", test1_listener)
+    with event_manager.owner("test2"):
+        event_manager.connect("test-event", test2_listener)
+    event_manager.connect("test-event", app_listener)
+
+    tenant = None
+    plugin_manager.tenant_loader(lambda: tenant)
+    plugin_manager.set_tenant_plugins("site1", ["test1"])
+    plugin_manager.set_tenant_plugins("site2", [])
+    assert plugin_manager.get_tenant_plugins("site1") == ["test1"]
+
+    assert event_manager.emit("test-event") == ["test1", "test2", "app"]
+
+    tenant = "site1"
+    assert event_manager.emit("test-event") == ["test1", "app"]
+    tenant = "site2"
+    assert event_manager.emit("test-event") == ["app"]
+    # tenants without own plugin set use all enabled plugins
+    tenant = "site3"
+    assert event_manager.emit("test-event") == ["test1", "test2", "app"]
+
+    # the dispatch lists are rebuilt when listeners change
+    tenant = "site1"
+    event_manager.remove("test-event", test1_listener)
+    assert event_manager.emit("test-event") == ["app"]
+
+    plugin_manager.set_tenant_plugins("site1", None)
+    assert event_manager.emit("test-event") == ["test2", "app"]
+
+    with pytest.raises(PluginError):
+        plugin_manager.set_tenant_plugins("site1", ["unknown"])
+
+
+def test_assets_not_configured(app, tmp_path):
+    plugin_manager = PluginManager(app)
+    assert "plugin_assets" not in app.view_functions
+    assert "plugin_assets" not in app.jinja_env.globals
+
+    # the route can't be added once the app handles requests
+    app.route("/")(lambda: "index")
+    app.test_client().get("/")
+    plugin_manager.assets_folder = str(tmp_path / "assets")
+    with pytest.raises(PluginError):
+        plugin_manager.build_assets()
+    assert not os.path.exists(tmp_path / "assets")
+
+
+def test_build_assets(app, tmp_path):
+    app.config["PLUGINS_ASSETS_FOLDER"] = str(tmp_path)
+    plugin_manager = PluginManager(app)
+    bundles = plugin_manager.build_assets()
+
+    assert sorted(bundles) == ["css", "js"]
+    assert not [name for name in os.listdir(tmp_path) if name.startswith(".tmp")]
+    with open(tmp_path / bundles["js"]) as fd:
+        js = fd.read()
+    assert js.index('console.log("test1")') < js.index('console.log("test2")')
+    with open(tmp_path / bundles["css"], "rb") as fd:
+        css = fd.read()
+    with gzip.open(tmp_path / (bundles["css"] + ".gz")) as fd:
+        assert fd.read() == css
+
+    # the manifest is loaded again on startup
+    assert PluginManager(app)._asset_manifest == bundles
+
+    with app.test_request_context():
+        tags = flask.render_template_string("{{ plugin_assets() }}")
+        css_url = plugin_manager.asset_urls()["css"]
+    assert f'<link rel="stylesheet" href="{css_url}">' in tags
+
+    client = app.test_client()
+    with client.get(css_url, headers={"Accept-Encoding": "gzip"}) as rv:
+        assert rv.headers["Content-Encoding"] == "gzip"
+        assert rv.headers["Content-Type"].startswith("text/css")
+        assert "immutable" in rv.headers["Cache-Control"]
+        assert gzip.decompress(rv.data) == css
+
+    with client.get(css_url) as rv:
+        assert "Content-Encoding" not in rv.headers
+        assert rv.data == css
+
+
+def test_reload_plugin(app):
+    plugin_manager = PluginManager(app, plugin_folder="unload_plugins")
+    plugin = plugin_manager.plugins["unloadable"]
+    try:
+        plugin_manager.disable_plugins([plugin])
+        plugin_manager.enable_plugins([plugin_manager.all_plugins["unloadable"]])
+    finally:
+        if os.path.exists(os.path.join(plugin.path, "DISABLED")):
+            os.remove(os.path.join(plugin.path, "DISABLED"))
+
+    reloaded = plugin_manager.plugins["unloadable"]
+    assert reloaded is not plugin
+    assert reloaded.enabled
+    assert plugin_manager.query(enabled=True).total == 1
+    assert app.test_client().get("/unloadable/").data == b"unloadable"
+    with app.test_request_context():
+        assert emit_event("test-event") == ["unloadable"]
+
+
+def test_unload_plugin(app):
+    app.route("/")(lambda: "index")
+    plugin_manager = PluginManager(app, plugin_folder="unload_plugins")
+    plugin = plugin_manager.plugins["unloadable"]
+    client = app.test_client()
+
+    assert client.get("/unloadable/").data == b"unloadable"
+    with app.test_request_context():
+        assert emit_event("test-event") == ["unloadable"]
+    module = weakref.ref(sys.modules["tests.unload_plugins.unloadable"])
+
+    try:
+        assert plugin_manager.disable_plugins([plugin]) == 1
+    finally:
+        os.remove(os.path.join(plugin.path, "DISABLED"))
+
+    assert not plugin.enabled
+    assert "unloadable" not in plugin_manager.plugins
+    assert type(plugin_manager.all_plugins["unloadable"]) is Plugin
+    assert "tests.unload_plugins.unloadable" not in sys.modules
+    assert "unloadable" not in app.blueprints
+    assert "unloadable" not in app.jinja_env.globals
+    assert client.get("/unloadable/").status_code == 404
+    assert client.get("/").data == b"index"
+    with app.test_request_context():
+        assert emit_event("test-event") == []
+
+    # plugins which weren't set up by the manager are only disabled
+    assert not plugin_manager.unload_plugin(plugin)
+
+    # after the first request plugins can't be loaded again
+    with pytest.raises(PluginError):
+        plugin_manager.enable_plugins([plugin_manager.all_plugins["unloadable"]])
+
+    # the plugin's objects can be collected
+    del plugin
+    gc.collect()
+    assert module() is None
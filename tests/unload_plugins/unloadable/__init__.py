@@ -0,0 +1,26 @@
+from flask import Blueprint
+from flask import current_app
+
+from flask_plugins import connect_event
+from flask_plugins import Plugin
+
+__plugin__ = "UnloadablePlugin"
+
+
+unloadable = Blueprint("unloadable", __name__)
+
+
+@unloadable.route("/")
+def index():
+    return "unloadable"
+
+
+def listener():
+    return "unloadable"
+
+
+class UnloadablePlugin(Plugin):
+    def setup(self):
+        current_app.register_blueprint(unloadable, url_prefix="/unloadable")
+        current_app.jinja_env.globals["unloadable"] = "unloadable"
+        connect_event("test-event", listener)